@@ -0,0 +1,162 @@
+# %%
+import numpy as np
+import pandas as pd
+
+from data_loading import (
+    D1,
+    D2,
+    US_POPULATION,
+    age_brackets,
+    age_membership,
+    age_profile,
+    get_risk_by_age,
+)
+from dose_redistributing_methods import PRIORITIES, redistribute_doses_batch
+from immunity import EFFICACY_D1, EFFICACY_D2, avg_immunity_arrays
+from profiling import profile
+
+
+# %% Benefit of a dose
+def risk_by_group(groups, risk=None, profile=US_POPULATION) -> pd.Series:
+    """Risk of each age group (e.g. "25-34"), averaged over the people in it.
+
+    Args:
+    - groups: Names of the age groups, see `age_brackets`.
+    - risk: Risk by (lowest, highest) age, defaults to `get_risk_by_age`.
+    - profile: Population by (lowest, highest) age, used to weight the ages within a group.
+    """
+    risk = risk or get_risk_by_age()
+    brackets = age_brackets(groups)
+    oldest = max(upper for _, upper in [*risk.keys(), *brackets.values()])
+    ages = age_membership(dict(enumerate(risk)), oldest)  # risk brackets x ages
+    per_age = np.array(list(risk.values())) @ ages
+    people = age_membership(brackets, oldest) * age_profile(profile, oldest)
+    return pd.Series(people @ per_age / people.sum(axis=1), index=list(groups))
+
+
+def dose_benefits(groups, risk=None, efficacy=(EFFICACY_D1, EFFICACY_D2)) -> pd.Series:
+    """Deaths averted by one more dose for each (dose, group), in units of the risk.
+    A first dose gives the efficacy of the first dose, a second dose only adds the difference.
+    """
+    r = risk_by_group(groups, risk)
+    e1, e2 = efficacy
+    benefits = {(D1, grp): e1 * r[grp] for grp in groups}
+    benefits.update({(D2, grp): (e2 - e1) * r[grp] for grp in groups})
+    return pd.Series(benefits)
+
+
+def solve_priorities(groups, risk=None, efficacy=(EFFICACY_D1, EFFICACY_D2)) -> list:
+    """Priority order (low to high, like `PRIORITIES`) with the largest benefit per dose first.
+
+    The benefit of a dose doesn't depend on how many doses a group already got, so giving every
+    dose to the open group with the largest benefit (greedy) maximizes the deaths averted on
+    every day, given the daily totals.
+    """
+    benefits = dose_benefits(groups, risk, efficacy)
+    return list(benefits.sort_values(kind="stable").index)
+
+
+@profile
+def allocate_by_benefit(vacc, pop, benefit, redistribute):
+    """Give each day's doses to the groups with the largest benefit per dose, for many regions at once.
+    The benefit can change from day to day, i.e. the allocation is solved again for every day.
+
+    First doses that aren't redistributed stay in their group if it still needs them,
+    everything else goes to the open groups in order of benefit (same as `redistribute_doses`
+    with the priority order of `solve_priorities` if the benefit doesn't change).
+
+    Args:
+    - vacc: (B, days, C) vaccinations per day, B regions and C (dose, group) columns.
+    - pop: (B, C) population of the group of each column.
+    - benefit: Benefit of a dose of each column, shape (C,), (B, C) or (B, days, C).
+    - redistribute: (C,) whether the doses of a column are redistributed.
+
+    Returns:
+        np.ndarray: (B, days, C) doses given
+    """
+    vacc = np.asarray(vacc, dtype=np.int64)
+    n_batch, n_days, n_cols = vacc.shape
+    benefit = np.asarray(benefit, dtype=float)
+    if benefit.ndim == 2:
+        benefit = benefit[:, None, :]
+    benefit = np.broadcast_to(benefit, vacc.shape)
+    need = np.array(np.broadcast_to(pop, (n_batch, n_cols)), dtype=np.int64)
+    own = np.where(redistribute, 0, vacc)  # doses that stay in their group
+    result = np.zeros_like(vacc)
+    for i in range(n_days):
+        kept = np.minimum(own[:, i], need)
+        need -= kept
+        free = vacc[:, i].sum(axis=-1) - kept.sum(axis=-1)
+        order = np.argsort(-benefit[:, i], axis=-1, kind="stable")
+        open_ = np.take_along_axis(need, order, axis=-1)
+        # doses needed by the groups with a larger benefit
+        ahead = open_.cumsum(axis=-1) - open_
+        given = np.zeros_like(need)
+        np.put_along_axis(
+            given, order, np.clip(free[:, None] - ahead, 0, open_), axis=-1
+        )
+        need -= given
+        result[:, i] = kept + given
+    return result
+
+
+# %% Comparison with the static priority list
+def compare_priorities(df, population, weights=None, regions=None) -> pd.DataFrame:
+    """Immunity with the real doses, the static priority list `PRIORITIES`, the priority order
+    of `solve_priorities` and `allocate_by_benefit`, all with the same daily dose totals.
+
+    Args:
+    - df pd.DataFrame: Vaccinations as returned by `get_vaccinations_at`, columns are (Region, dose, group).
+    - population pd.DataFrame: Population per age group (index) and region (columns).
+    - weights: Dict of name -> weights per age group (missing groups get 0).
+        Weighting by risk (population times `risk_by_group`, i.e. share of deaths averted) is always included.
+    - regions: Regions to compare, defaults to all regions in `df`.
+
+    Returns:
+        pd.DataFrame: Weighted immunity averaged over all days, (Region, weighting) as index and
+        one column per allocation, plus the change of the solved order relative to the static list
+    """
+    regions = regions or list(df.columns.unique(level=0))
+    columns = list(df[regions[0]][[D1, D2]].columns)
+    groups = [grp for d, grp in columns if d == D1]
+    d1 = [columns.index((D1, grp)) for grp in groups]
+    d2 = [columns.index((D2, grp)) for grp in groups]
+    pop = np.stack([population[r][groups].to_numpy() for r in regions])
+    pop_c = np.stack([population[r][[grp for _, grp in columns]] for r in regions])
+
+    scenarios = {
+        "Static": dict(priority=PRIORITIES),
+        "Solved": dict(priority=solve_priorities(groups)),
+    }
+    rd = redistribute_doses_batch(df, population, scenarios, regions)
+    vacc = np.stack([df[r][[D1, D2]][columns].to_numpy() for r in regions])
+    doses = {"Actual": vacc}
+    for s in scenarios:
+        doses[s] = np.stack([rd[r][s][columns].to_numpy() for r in regions])
+    benefit = dose_benefits(groups)[columns].to_numpy()
+    redistribute = np.array([d == D2 for d, _ in columns])
+    doses["Greedy"] = allocate_by_benefit(vacc, pop_c, benefit, redistribute)
+
+    w = {"Risk": pop * risk_by_group(groups).to_numpy()}  # deaths without vaccine
+    for name, weight in (weights or {}).items():
+        w[name] = np.broadcast_to(
+            weight.reindex(groups).fillna(0).to_numpy(), pop.shape
+        )
+    scores = dict()
+    for schedule, v in doses.items():
+        # regions x days x groups
+        imm = avg_immunity_arrays(v[..., d1], v[..., d2], pop)
+        for name, weight in w.items():
+            total = weight.sum(axis=-1)[:, None]
+            weighted = (imm * weight[:, None, :]).sum(axis=-1) / total
+            for r, score in zip(regions, weighted.mean(axis=-1)):
+                scores.setdefault((r, name), dict())[schedule] = score
+    result = pd.DataFrame.from_dict(scores, orient="index")
+    result.index = pd.MultiIndex.from_tuples(
+        result.index, names=["Region", "Weighting"]
+    )
+    result["Solved vs Static"] = result["Solved"] / result["Static"] - 1
+    return result
+
+
+# %%
@@ -1,27 +1,61 @@
 #%%
-import altair as alt
-import matplotlib.pyplot as plt
+import functools
+from collections import namedtuple
+
 import pandas as pd
-import seaborn as sns
 
-from dose_redistributing_methods import redistribute_doses
+from allocation import compare_priorities
+from build import TaskGraph
+from dose_redistributing_methods import redistribute_doses, redistribute_doses_batch
 from data_loading import *
+from immunity import calc_weighted_immunity, get_avg_immunity
+from profiling import finish, profile
+from rendering import RenderQueue, figure, print_timings
+from uncertainty import immunity_bands, sample_shares
 from utility import write_img_to_file, write_to_file
 
 from pathlib import Path
 
-sns.set_theme()
 PLOT_FOLDER = Path("Y:/GitRepos/oerpli.github.io/fdf")
+# Fingerprints and results of the incremental build (see TaskGraph), kept out of PLOT_FOLDER
+BUILD_FOLDER = Path("./.build")
 
 ALTAIR_WIDTH = 500
-plt.rcParams["figure.figsize"] = [10, 5]
 
-deaths_at = get_deaths_by_age_at()
+# Chart data is inline in every chart by default. With SHARED_CHART_DATA it is saved once per
+# region and scenario (see `ChartData`) and loaded by the charts from CHART_DATA_URL,
+# i.e. the blog has to serve the CSV files of PLOT_FOLDER there.
+SHARED_CHART_DATA = False
+CHART_DATA_URL = "/fdf"  # where the blog serves PLOT_FOLDER
+CHART_FREQ = None  # e.g. "W" for one point per week
+CHART_DECIMALS = None  # e.g. 4 to round the shared data
+
+# Number of samples of the uncertain inputs (efficacy, death shares) for percentile bands
+# of the immunity (see uncertainty.py), 0 to skip
+UNCERTAINTY_SAMPLES = 0
+
+
+# Plotting libraries take seconds to import, they are only loaded when the first chart is made
+@functools.cache
+def altair():
+    import altair as alt
+
+    return alt
+
+
+@functools.cache
+def pyplot():
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    sns.set_theme()
+    plt.rcParams["figure.figsize"] = [10, 5]
+    return plt
 
 
 def save_fig(ax, name, alt_text=None, caption=None):
     path = vlbg_img / f"{name}.png"
-    plt.savefig(path)
+    pyplot().savefig(path)
     write_img_to_file(vlbg_report, name, path, alt_text=alt_text, caption=caption)
 
 
@@ -31,36 +65,95 @@ def save_table(df: pd.DataFrame, name: str):
 
 
 #%% Get Data Austria
-df_full = get_vaccinations_at()
-population = get_demographics_at()
-pt = pd.DataFrame(population.unstack()).T
-
-
-def get_avg_immunity(df, pop):
-    df = df.cumsum().copy()
-    df[D1] -= df[D2]  # D1 contains now only 1st dose instead
-    imm_p = df[D1].copy() * 0
-    imm_p += (df[D1] * 0.89) / pop
-    imm_p += (df[D2] * 0.95) / pop
-    return imm_p
-
-
-def create_altair_plot_immunity(imm, title, name=None):
+@functools.cache
+def load_data():
+    """Vaccinations, population (also as single row) and deaths by age of Austria"""
+    df_full = get_vaccinations_at()
+    population = get_demographics_at()
+    pt = pd.DataFrame(population.unstack()).T
+    return df_full, population, pt, get_deaths_by_age_at()
+
+
+if __name__ == "__main__":
+    df_full, population, pt, deaths_at = load_data()
+
+
+# %% Charts
+# Data of a chart that is stored in a `ChartData` file
+ChartColumns = namedtuple("ChartColumns", ["url", "prefix", "columns"])
+
+
+class ChartData:
+    """Data of several charts, saved once as CSV that the chart specs reference by URL.
+
+    Args:
+    - name: File name, without extension.
+    - freq: Downsample to this frequency (e.g. "W"), keeps the last value of each period.
+    - decimals: Round values to this number of decimals.
+    """
+
+    def __init__(self, name, freq=None, decimals=None) -> None:
+        self.name = name
+        self.freq = freq
+        self.decimals = decimals
+        self.frames = []
+
+    @property
+    def file(self) -> Path:
+        return PLOT_FOLDER / f"data_{self.name}.csv"
+
+    @property
+    def url(self) -> str:
+        return f"{CHART_DATA_URL}/{self.file.name}"
+
+    def add(self, df: pd.DataFrame) -> ChartColumns:
+        """Store the columns of `df`, the result can be plotted instead of `df`"""
+        prefix = f"{len(self.frames)}|"
+        self.frames.append(df.add_prefix(prefix))
+        return ChartColumns(self.url, prefix, list(self.frames[-1].columns))
+
+    @profile
+    def save(self):
+        df = pd.concat(self.frames, axis=1)
+        if self.freq:
+            df = df.resample(self.freq).last()
+        if self.decimals is not None:
+            df = df.round(self.decimals)
+        df.index = df.index.strftime("%Y-%m-%d")
+        df.to_csv(self.file, index_label="Date")
+
+
+def chart_base(df, var_name, value_name):
+    """Chart of the columns of `df` in long format (Date, `var_name`, `value_name`).
+    `df` is a DataFrame (embedded in the chart) or `ChartColumns` (loaded from their URL).
+    """
+    alt = altair()
+    if isinstance(df, ChartColumns):
+        return (
+            alt.Chart(alt.UrlData(df.url), width=ALTAIR_WIDTH)
+            .transform_fold(df.columns, as_=["column", value_name])
+            .transform_calculate(**{var_name: f"slice(datum.column, {len(df.prefix)})"})
+        )
     chart_data = pd.melt(
-        imm.reset_index(),
+        df.reset_index(),
         id_vars="Date",
-        value_vars=imm.columns,
-        var_name="Age Group",
-        value_name="Immunity",
+        value_vars=df.columns,
+        var_name=var_name,
+        value_name=value_name,
     )
+    return alt.Chart(chart_data, width=ALTAIR_WIDTH)
+
+
+def create_altair_plot_immunity(imm, title, name=None):
+    alt = altair()
     chart = (
-        alt.Chart(chart_data, width=ALTAIR_WIDTH)
+        chart_base(imm, "Age Group", "Immunity")
         .mark_line(clip=True)
         .encode(
-            x="Date",
-            y=alt.Y("Immunity", scale=alt.Scale(domain=(0, 1))),
-            color="Age Group",
-            strokeDash="Age Group",
+            x="Date:T",
+            y=alt.Y("Immunity:Q", scale=alt.Scale(domain=(0, 1))),
+            color="Age Group:N",
+            strokeDash="Age Group:N",
         )
         .properties(title=f"Estimated Immunity: {title}")
         .interactive()
@@ -72,21 +165,14 @@ def create_altair_plot_immunity(imm, title, name=None):
 
 #%%
 def create_altair_plot_vacc(vacc, title, name=None):
-    chart_data = pd.melt(
-        vacc.reset_index(),
-        id_vars="Date",
-        value_vars=vacc.columns,
-        var_name="Age Group",
-        value_name="Vaccinations",
-    )
     chart = (
-        alt.Chart(chart_data, width=ALTAIR_WIDTH)
+        chart_base(vacc, "Age Group", "Vaccinations")
         .mark_line(clip=True)
         .encode(
-            x="Date",
-            y="Vaccinations",
-            color="Age Group",
-            strokeDash="Age Group",
+            x="Date:T",
+            y="Vaccinations:Q",
+            color="Age Group:N",
+            strokeDash="Age Group:N",
         )
         .properties(title=f"Number of vaccinations: {title}")
         .interactive()
@@ -98,21 +184,15 @@ def create_altair_plot_vacc(vacc, title, name=None):
 
 #%%
 def create_altair_plot_weighted_immunity(imm_w, title, name=None):
-    chart_data = pd.melt(
-        imm_w.reset_index(),
-        id_vars="Date",
-        value_vars=imm_w.columns,
-        var_name="Weighted by",
-        value_name="Immunity",
-    )
+    alt = altair()
     chart = (
-        alt.Chart(chart_data, width=ALTAIR_WIDTH)
+        chart_base(imm_w, "Weighted by", "Immunity")
         .mark_line(clip=True)
         .encode(
-            x="Date",
-            y=alt.Y("Immunity", scale=alt.Scale(domain=(0, 1))),
-            color="Weighted by",
-            strokeDash="Weighted by",
+            x="Date:T",
+            y=alt.Y("Immunity:Q", scale=alt.Scale(domain=(0, 1))),
+            color="Weighted by:N",
+            strokeDash="Weighted by:N",
         )
         .properties(title=f"Weighted average immunity: {title}")
         .interactive()
@@ -124,21 +204,15 @@ def create_altair_plot_weighted_immunity(imm_w, title, name=None):
 
 #%%
 def create_altair_plot_at_least_1d(df, title, name=None):
-    chart_data = pd.melt(
-        df.reset_index(),
-        id_vars=["Date"],
-        value_vars=df.columns,
-        var_name="Age group",
-        value_name="Fraction",
-    )
+    alt = altair()
     chart = (
-        alt.Chart(chart_data, width=ALTAIR_WIDTH)
+        chart_base(df, "Age group", "Fraction")
         .mark_line(clip=True)
         .encode(
-            x="Date",
-            y=alt.Y("Fraction", scale=alt.Scale(domain=(0, 1))),
-            color="Age group",
-            strokeDash="Age group",
+            x="Date:T",
+            y=alt.Y("Fraction:Q", scale=alt.Scale(domain=(0, 1))),
+            color="Age group:N",
+            strokeDash="Age group:N",
         )
         .properties(title=f"At least one dose: {title}")
         .interactive()
@@ -148,19 +222,6 @@ def create_altair_plot_at_least_1d(df, title, name=None):
     return chart
 
 
-#%%
-def calc_weighted_immunity(imm, weights) -> pd.DataFrame:
-    dfs = []
-    for name, weight in weights.items():
-        imm_w = (imm * weight).sum(axis=1) / weight.sum()
-        df = pd.DataFrame({name: imm_w})
-        dfs.append(df)
-    a, *bs = dfs
-    for b in bs:
-        a = a.join(b)
-    return a
-
-
 #%%
 region_names = {
     "Burgenland": "at-bg",
@@ -176,6 +237,28 @@ region_names = {
 }
 
 
+def plot_immunity(imm, title, name):
+    pyplot()  # theme, workers load it on their first plot
+    fig = figure()
+    ax = imm.plot(ax=fig.add_subplot(), title=title)
+    ax.set_ylim(0, 1)
+    fig.savefig(PLOT_FOLDER / f"{name}.png")
+
+
+# Files written by the chart functions, the name is their last argument
+CHART_FILES = {
+    create_altair_plot_immunity: "imm_{}.json",
+    create_altair_plot_vacc: "vacc_{}.json",
+    create_altair_plot_weighted_immunity: "imm_w{}.json",
+    create_altair_plot_at_least_1d: "_1d_{}.json",
+    plot_immunity: "{}.png",
+}
+
+
+def chart_files(fn, args) -> list:
+    return [PLOT_FOLDER / CHART_FILES[fn].format(args[-1])]
+
+
 def get_vaccination_rate(df, pop) -> pd.DataFrame:
     vacc_rate = df.copy().cumsum()
     vacc_rate[D1] /= pop
@@ -185,97 +268,199 @@ def get_vaccination_rate(df, pop) -> pd.DataFrame:
 
 regions = region_names  # all regions
 # regions = {"Österreich": "at"}  # for debugging
-for fd in [True, False]:
-    fds = "_fd" if fd else ""
-    for nice, short in regions.items():
-        df = df_full[nice]  # get subset of region
-        pop = pt[nice].loc[0]  # get population of region
-        dfv = df[[D1, D2]]  # 1D,2D get vaccination data of region
-        # Choose one from the following two
-        rd = redistribute_doses(dfv, pop, distr_first=False, fractional_dosing=fd)
-        # This method basically ignores members of "critical groups" except old people
-        # Gives nicer but likely wrong numbers.
-        # rd = redistribute_doses(dfv, pop, distr_first=True) # also reassign first doses based on prio
-
-        imm_normal = get_avg_immunity(dfv, pop)
-        imm_fdf = get_avg_immunity(rd, pop)
-
-        print(f"FD {fd}: {rd.sum().sum()}")
-        print(f"FD {fd}: {dfv.sum().sum()}")
-
-        weightings = {
-            "Population": pop,  # calc immunity on average
-            "Death distribution": deaths_at.loc["Deaths"],  # weighted by deaths
-        }
-
-        imm_w_n = calc_weighted_immunity(imm_normal, weightings)
-        imm_w_fdf = calc_weighted_immunity(imm_fdf, weightings)
-        imm_w = imm_w_n.join(imm_w_fdf, rsuffix=" (FDF)", lsuffix=" (Normal)")
-        per_pop_c = imm_w.columns[0::2]
-        per_death_c = imm_w.columns[1::2]
-        total = dfv[D1] + dfv[D2]
-
-        # Avg immunity plot per age group, normal and FDF
-        create_altair_plot_immunity(imm_normal, f"{nice}", f"real_{short}{fds}")
-        create_altair_plot_immunity(imm_fdf, f"{nice} (FDF)", f"fdf_{short}{fds}")
-
-        # FDF + FD Comparison
-        vrr = get_vaccination_rate(dfv, pop)
-        vr_fdf = get_vaccination_rate(rd, pop)
-        # vr_fdf_fd = get_vaccination_rate(rdfd, pop)
-
-        create_altair_plot_at_least_1d(vrr[D1], f"{nice} (normal)")
-        create_altair_plot_at_least_1d(vr_fdf[D1], f"{nice} (FDF)")
-        # create_altair_plot_at_least_1d(vr_fdf_fd[D1], f"{nice} (FDF + FD)")
-
-        # Weighted average immunity for FDF, population and death distribution weighted
-        create_altair_plot_weighted_immunity(
-            imm_w[per_pop_c], f"{nice}", f"p_{short}{fds}"
-        )
-        create_altair_plot_weighted_immunity(
-            imm_w[per_death_c], f"{nice}", f"d_{short}{fds}"
-        )
-
-        # Vaccination progress, Total, Real, alternative FDF data
-        create_altair_plot_vacc(total.cumsum(), f"{nice} Total", f"real_t_{short}{fds}")
-        create_altair_plot_vacc(
-            dfv[D1].cumsum(), f"{nice} {D1}", f"real_d1_{short}{fds}"
-        )
-        create_altair_plot_vacc(
-            dfv[D2].cumsum(), f"{nice} {D2}", f"real_d2_{short}{fds}"
-        )
-        create_altair_plot_vacc(
-            rd[D1].cumsum(), f"{nice} {D1} (FDF)", f"fdf_d1_{short}{fds}"
-        )
-        create_altair_plot_vacc(
-            rd[D2].cumsum(), f"{nice} {D2} (FDF)", f"fdf_d2_{short}{fds}"
-        )
-
-        # plot immunity levels with matplotlib
-        ax = imm_normal.plot(title=f"Immunity {nice}")
-        ax.set_ylim(0, 1)
-        ax2 = imm_fdf.plot(title=f"FDF Immunity {nice}")
-        ax2.set_ylim(0, 1)
+# Choose one from the following two
+scenarios = {fd: dict(distr_first=False, fractional_dosing=fd) for fd in [True, False]}
+# This method basically ignores members of "critical groups" except old people
+# Gives nicer but likely wrong numbers.
+# scenarios = {fd: dict(distr_first=True, fractional_dosing=fd) for fd in [True, False]} # also reassign first doses based on prio
+if __name__ == "__main__":
+    # Only outdated results and charts are recalculated, see TaskGraph
+    build = TaskGraph(
+        BUILD_FOLDER,
+        salt=(ALTAIR_WIDTH, CHART_DATA_URL, CHART_FREQ, CHART_DECIMALS),
+    )
+    # charts are collected and rendered in parallel after the loop
+    jobs = RenderQueue(build, chart_files)
+    rd_all = build.cached(
+        "redistribution",
+        redistribute_doses_batch,
+        df_full,
+        population,
+        scenarios,
+        list(regions),
+    )
+    if UNCERTAINTY_SAMPLES:
+        shares = sample_shares(deaths_at.loc["Deaths"], UNCERTAINTY_SAMPLES)
+        shares = pd.DataFrame(shares, columns=deaths_at.columns)
+        for fd in scenarios:
+            bands = build.cached(
+                f"uncertainty{'_fd' if fd else ''}",
+                immunity_bands,
+                {"Normal": df_full, "FDF": rd_all.xs(fd, axis=1, level=1)},
+                population,
+                {"Death distribution": shares},
+                list(regions),
+                UNCERTAINTY_SAMPLES,
+            )
+            bands.to_csv(PLOT_FOLDER / f"uncertainty{'_fd' if fd else ''}.csv")
+    # priority order solved from the risk by age vs PRIORITIES
+    allocation = build.cached(
+        "allocation",
+        compare_priorities,
+        df_full,
+        population,
+        {"Death distribution": deaths_at.loc["Deaths"]},
+        list(regions),
+    )
+    print(allocation.to_string(float_format="{:.4f}".format))
+    for fd in scenarios:
+        fds = "_fd" if fd else ""
+        for nice, short in regions.items():
+            data = ChartData(f"{short}{fds}", CHART_FREQ, CHART_DECIMALS)
+            src = data.add if SHARED_CHART_DATA else lambda df: df
+            df = df_full[nice]  # get subset of region
+            pop = pt[nice].loc[0]  # get population of region
+            dfv = df[[D1, D2]]  # 1D,2D get vaccination data of region
+            rd = rd_all[nice][fd]  # redistributed doses of region
+
+            imm_normal = get_avg_immunity(dfv, pop)
+            imm_fdf = get_avg_immunity(rd, pop)
+
+            print(f"FD {fd}: {rd.sum().sum()}")
+            print(f"FD {fd}: {dfv.sum().sum()}")
+
+            weightings = {
+                "Population": pop,  # calc immunity on average
+                "Death distribution": deaths_at.loc["Deaths"],  # weighted by deaths
+            }
+
+            imm_w_n = calc_weighted_immunity(imm_normal, weightings)
+            imm_w_fdf = calc_weighted_immunity(imm_fdf, weightings)
+            imm_w = imm_w_n.join(imm_w_fdf, rsuffix=" (FDF)", lsuffix=" (Normal)")
+            per_pop_c = imm_w.columns[0::2]
+            per_death_c = imm_w.columns[1::2]
+            total = dfv[D1] + dfv[D2]
+
+            # Avg immunity plot per age group, normal and FDF
+            jobs.add(
+                create_altair_plot_immunity,
+                src(imm_normal),
+                f"{nice}",
+                f"real_{short}{fds}",
+            )
+            jobs.add(
+                create_altair_plot_immunity,
+                src(imm_fdf),
+                f"{nice} (FDF)",
+                f"fdf_{short}{fds}",
+            )
+
+            # FDF + FD Comparison
+            vrr = get_vaccination_rate(dfv, pop)
+            vr_fdf = get_vaccination_rate(rd, pop)
+            # vr_fdf_fd = get_vaccination_rate(rdfd, pop)
+
+            jobs.add(
+                create_altair_plot_at_least_1d,
+                src(vrr[D1]),
+                f"{nice} (normal)",
+                f"real_{short}{fds}",
+            )
+            jobs.add(
+                create_altair_plot_at_least_1d,
+                src(vr_fdf[D1]),
+                f"{nice} (FDF)",
+                f"fdf_{short}{fds}",
+            )
+            # jobs.add(create_altair_plot_at_least_1d, src(vr_fdf_fd[D1]), f"{nice} (FDF + FD)")
+
+            # Weighted average immunity for FDF, population and death distribution weighted
+            jobs.add(
+                create_altair_plot_weighted_immunity,
+                src(imm_w[per_pop_c]),
+                f"{nice}",
+                f"p_{short}{fds}",
+            )
+            jobs.add(
+                create_altair_plot_weighted_immunity,
+                src(imm_w[per_death_c]),
+                f"{nice}",
+                f"d_{short}{fds}",
+            )
+
+            # Vaccination progress, Total, Real, alternative FDF data
+            jobs.add(
+                create_altair_plot_vacc,
+                src(total.cumsum()),
+                f"{nice} Total",
+                f"real_t_{short}{fds}",
+            )
+            jobs.add(
+                create_altair_plot_vacc,
+                src(dfv[D1].cumsum()),
+                f"{nice} {D1}",
+                f"real_d1_{short}{fds}",
+            )
+            jobs.add(
+                create_altair_plot_vacc,
+                src(dfv[D2].cumsum()),
+                f"{nice} {D2}",
+                f"real_d2_{short}{fds}",
+            )
+            jobs.add(
+                create_altair_plot_vacc,
+                src(rd[D1].cumsum()),
+                f"{nice} {D1} (FDF)",
+                f"fdf_d1_{short}{fds}",
+            )
+            jobs.add(
+                create_altair_plot_vacc,
+                src(rd[D2].cumsum()),
+                f"{nice} {D2} (FDF)",
+                f"fdf_d2_{short}{fds}",
+            )
+            if SHARED_CHART_DATA and build.outdated(
+                data.file.name, data.frames, outputs=[data.file]
+            ):
+                data.save()
+
+            # plot immunity levels with matplotlib
+            jobs.add(
+                plot_immunity, imm_normal, f"Immunity {nice}", f"imm_real_{short}{fds}"
+            )
+            jobs.add(
+                plot_immunity, imm_fdf, f"FDF Immunity {nice}", f"imm_fdf_{short}{fds}"
+            )
+
+    print_timings(jobs.run())
+    build.done()
+    build.save()
+    print(f"{build.stats['run']} tasks run, {build.stats['skipped']} up to date")
+    finish()
 
 # %% Test stuff
-create_altair_plot_vacc(rd[D2].cumsum(), f"{nice} {D2} (FDF)")
-create_altair_plot_vacc(rd[D2].cumsum(), f"{nice} {D2} (FDF)")
-create_altair_plot_vacc(rd[D2].cumsum(), f"{nice} {D2} (FDF)")
+if __name__ == "__main__":
+    create_altair_plot_vacc(rd[D2].cumsum(), f"{nice} {D2} (FDF)")
+    create_altair_plot_vacc(rd[D2].cumsum(), f"{nice} {D2} (FDF)")
+    create_altair_plot_vacc(rd[D2].cumsum(), f"{nice} {D2} (FDF)")
 
+    since_new_dosing = dfv.loc["2021-03-14":]
 
-since_new_dosing = dfv.loc["2021-03-14":]
-
-young, middle, old = ["25-34", "35-44", "45-54"], ["55-64", "65-74"], ["75-84", "85-99"]
-yd1 = since_new_dosing[D1][young].sum().sum()
-yd2 = since_new_dosing[D2][young].sum().sum()
-md1 = since_new_dosing[D1][middle].sum().sum()
-md2 = since_new_dosing[D2][middle].sum().sum()
-od1 = since_new_dosing[D1][old].sum().sum()
-od2 = since_new_dosing[D2][old].sum().sum()
-
-print(yd1, yd2)
-print(md1, md2)
-print(od1, od2)
+    young, middle, old = (
+        ["25-34", "35-44", "45-54"],
+        ["55-64", "65-74"],
+        ["75-84", "85-99"],
+    )
+    yd1 = since_new_dosing[D1][young].sum().sum()
+    yd2 = since_new_dosing[D2][young].sum().sum()
+    md1 = since_new_dosing[D1][middle].sum().sum()
+    md2 = since_new_dosing[D2][middle].sum().sum()
+    od1 = since_new_dosing[D1][old].sum().sum()
+    od2 = since_new_dosing[D2][old].sum().sum()
+
+    print(yd1, yd2)
+    print(md1, md2)
+    print(od1, od2)
 
 # %% Test germany
 if False:
@@ -0,0 +1,90 @@
+# %%
+"""Import time of the modules of this repo.
+
+Every module is imported in a fresh interpreter. Fails (exit code 1) if an import
+- takes longer than `--max-seconds` (pandas and numpy are imported before timing),
+- reads data (calls to the pandas readers are recorded), or
+- loads a plotting library.
+
+Run from the repository root: python benchmarks/import_time.py
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+MODULES = [
+    "utility",
+    "cache",
+    "data_loading",
+    "dose_redistributing_methods",
+    "immunity",
+    "efficacy",
+    "sweep",
+    "store",
+    "rendering",
+    "build",
+    "profiling",
+    "uncertainty",
+    "allocation",
+    "at_analysis",
+]
+HEAVY = ["altair", "matplotlib", "seaborn"]
+READERS = ["read_csv", "read_excel", "read_parquet", "read_json"]
+
+CHECK = """
+import json, sys, time
+import numpy, pandas
+reads = []
+for name in {readers!r}:
+    setattr(pandas, name, lambda *args, _name=name, **kwargs: reads.append(_name))
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps(dict(seconds=seconds, reads=reads, heavy=heavy)))
+"""
+
+
+def measure(module, repeat=3) -> dict:
+    """Best of `repeat` imports of `module`, each in a new process"""
+    results = []
+    for _ in range(repeat):
+        code = CHECK.format(module=module, readers=READERS, heavy=HEAVY)
+        proc = subprocess.run(
+            [sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True
+        )
+        if proc.returncode != 0:
+            return dict(seconds=None, reads=[], heavy=[], error=proc.stderr.strip())
+        results.append(json.loads(proc.stdout.splitlines()[-1]))
+    return min(results, key=lambda r: r["seconds"])
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-seconds", type=float, default=0.5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    args = parser.parse_args(args)
+
+    failed = False
+    for module in args.modules:
+        r = measure(module, args.repeat)
+        problems = [r["error"].splitlines()[-1]] if "error" in r else []
+        if r["seconds"] is not None and r["seconds"] > args.max_seconds:
+            problems.append(f"slower than {args.max_seconds:.2f}s")
+        if r["reads"]:
+            problems.append(f"reads data ({', '.join(r['reads'])})")
+        if r["heavy"]:
+            problems.append(f"imports {', '.join(r['heavy'])}")
+        seconds = "-" if r["seconds"] is None else f"{r['seconds']:.3f}s"
+        print(f"{module:<30} {seconds:>8}  {'; '.join(problems) or 'ok'}")
+        failed = failed or bool(problems)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,340 @@
+# %%
+"""Benchmarks of the data loaders and the dose/immunity engines on synthetic data.
+
+All data is generated (see synthetic.py) and cached in a temporary folder, nothing is downloaded.
+Results can be saved as JSON baseline and compared with a later run, e.g.
+
+    python benchmarks/run.py --scale medium --save baseline.json
+    (change something)
+    python benchmarks/run.py --scale medium --compare baseline.json
+
+Comparing fails (exit code 1) if a benchmark got slower by more than `--threshold`.
+`--check` compares the results of the dose engines with the reference implementation instead.
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import synthetic
+
+import data_loading
+from allocation import allocate_by_benefit, dose_benefits
+from cache import DataCache
+from data_loading import D1, D2
+from dose_redistributing_methods import (
+    check_redistribution,
+    redistribute_doses,
+    redistribute_doses_batch,
+)
+from immunity import (
+    KERNELS,
+    calc_immunity_1d,
+    calc_immunity_2d,
+    calc_immunity_age,
+    calc_weighted_immunity,
+    get_avg_immunity,
+)
+
+ROOT = synthetic.ROOT
+
+# days, AT regions, OWID countries, age groups of the engines
+SCALES = {
+    "small": dict(days=120, regions=10, countries=50, groups=8),
+    "medium": dict(days=365, regions=20, countries=200, groups=16),
+    "large": dict(days=730, regions=50, countries=1000, groups=32),
+}
+
+# Benchmark name -> setup, `setup(config)` prepares the input and returns the function to time
+BENCHMARKS = dict()
+
+
+def benchmark(name):
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return decorator
+
+
+# %% Loaders, timed without the memoized result (raw data comes from the cache like in normal use)
+@benchmark("get_vaccinations_at")
+def bench_get_vaccinations_at(config):
+    data_loading.get_vaccinations_at()
+    return data_loading.get_vaccinations_at.__wrapped__
+
+
+@benchmark("get_age_data")
+def bench_get_age_data(config):
+    data_loading.get_age_data()
+    return data_loading.get_age_data.__wrapped__
+
+
+@benchmark("get_death_data_by_age")
+def bench_get_death_data_by_age(config):
+    data_loading.get_death_data_by_age()
+    return data_loading.get_death_data_by_age.__wrapped__
+
+
+# %% Engines
+@benchmark("redistribute_doses")
+def bench_redistribute_doses(config):
+    df, pop = synthetic.vaccinations(config["days"], config["groups"])
+    groups = list(pop.index)
+    priority = synthetic.priorities(groups)
+    return lambda: redistribute_doses(
+        df["Region 0"], pop["Region 0"], priority=priority
+    )
+
+
+def scenarios(groups):
+    """Scenarios of `redistribute_doses_batch` covering all options"""
+    priority = synthetic.priorities(groups)
+    fractions = dict(zip(groups, np.linspace(0.25, 1, len(groups))))
+    return {
+        "priority": dict(priority=priority),
+        "distr_first": dict(priority=priority, distr_first=True),
+        "fractional": dict(
+            priority=priority, fractional_dosing=True, fractional_doses=fractions
+        ),
+    }
+
+
+@benchmark("redistribute_doses_batch")
+def bench_redistribute_doses_batch(config):
+    df, pop = synthetic.vaccinations(
+        config["days"], config["groups"], config["regions"]
+    )
+    s = scenarios(list(pop.index))
+    return lambda: redistribute_doses_batch(df, pop, s)
+
+
+# same work as redistribute_doses_batch, one region and scenario at a time
+@benchmark("redistribute_doses_loop")
+def bench_redistribute_doses_loop(config):
+    df, pop = synthetic.vaccinations(
+        config["days"], config["groups"], config["regions"]
+    )
+    s = scenarios(list(pop.index))
+    return lambda: [
+        redistribute_doses(df[r], pop[r], **kwargs)
+        for r in pop.columns
+        for kwargs in s.values()
+    ]
+
+
+@benchmark("allocate_by_benefit")
+def bench_allocate_by_benefit(config):
+    df, pop = synthetic.vaccinations(
+        config["days"], config["groups"], config["regions"]
+    )
+    columns = list(df[pop.columns[0]].columns)
+    vacc = np.stack([df[r][columns].to_numpy() for r in pop.columns])
+    pop_c = np.stack([pop[r][[grp for _, grp in columns]] for r in pop.columns])
+    benefit = dose_benefits(list(pop.index))[columns].to_numpy()
+    redistribute = np.array([d == D2 for d, _ in columns])
+    return lambda: allocate_by_benefit(vacc, pop_c, benefit, redistribute)
+
+
+@benchmark("calc_weighted_immunity")
+def bench_calc_weighted_immunity(config):
+    df, pop = synthetic.vaccinations(
+        config["days"], config["groups"], config["regions"]
+    )
+    rng = np.random.default_rng(0)
+    imm = [get_avg_immunity(df[r], pop[r]) for r in pop.columns]
+    weights = {
+        "Population": pop.iloc[:, 0],
+        "Deaths": pd.Series(rng.uniform(0, 1, len(pop)), index=pop.index),
+    }
+    return lambda: [calc_weighted_immunity(i, weights) for i in imm]
+
+
+def daily_vaccinations():
+    path = data_loading.DATA[data_loading.Sources.Vaccinations]
+    df = pd.read_csv(path, usecols=["date", "location", "daily_vaccinations"])
+    return df.pivot(index="date", columns="location", values="daily_vaccinations")
+
+
+# calc_immunity_*_age of old/FDF.py load the real data, the calculation is the same
+@benchmark("calc_immunity_1d")
+def bench_calc_immunity_1d(config):
+    vacc = daily_vaccinations()
+    return lambda: calc_immunity_1d(vacc)
+
+
+@benchmark("calc_immunity_2d")
+def bench_calc_immunity_2d(config):
+    vacc = daily_vaccinations()
+    return lambda: calc_immunity_2d(vacc)
+
+
+@benchmark("calc_immunity_1d_age")
+def bench_calc_immunity_1d_age(config):
+    vacc, age = daily_vaccinations(), data_loading.get_age_data()
+    return lambda: calc_immunity_age(vacc, age, KERNELS[D1])
+
+
+@benchmark("calc_immunity_2d_age")
+def bench_calc_immunity_2d_age(config):
+    vacc, age = daily_vaccinations(), data_loading.get_age_data()
+    return lambda: calc_immunity_age(vacc, age, KERNELS[D2], backlog=True)
+
+
+# %% Checking the results of the engines
+def check(config, seed=0) -> list:
+    """Compare `redistribute_doses` with the reference `redistribute_doses_pandas` (first region)
+    and `redistribute_doses_batch` with `redistribute_doses` (all regions), for every scenario.
+    Only the first half of the days is used, s.t. groups fill up but there are no doses left
+    once everybody is vaccinated (the reference fails then). Returns the failed cases.
+    """
+    df, pop = synthetic.vaccinations(
+        config["days"], config["groups"], config["regions"], seed
+    )
+    df = df.iloc[: config["days"] // 2]
+    s = scenarios(list(pop.index))
+    s["fractional_distr_first"] = dict(s["fractional"], distr_first=True)
+    batch = redistribute_doses_batch(df, pop, s)
+    need = pop.loc[[grp for _, grp in df[pop.columns[0]].columns]].to_numpy()
+    failed = []
+    for name, kwargs in s.items():
+        if not check_redistribution(df[pop.columns[0]], pop.iloc[:, 0], **kwargs):
+            failed.append(f"{name}: redistribute_doses")
+        filled = 0
+        for i, r in enumerate(pop.columns):
+            single = redistribute_doses(df[r], pop[r], **kwargs)
+            if not (batch[r][name].to_numpy() == single.to_numpy()).all():
+                failed.append(f"{name}: redistribute_doses_batch ({r})")
+            filled += (single.sum().to_numpy() >= need[:, i]).sum()
+        print(f"{name:<30} {filled} of {need.size} columns filled up")
+    return failed
+
+
+# %% Running and comparing
+def measure(fn, repeat) -> dict:
+    """Seconds of `repeat` calls of `fn`, after one call to warm up"""
+    fn()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return dict(
+        min=min(seconds),
+        median=statistics.median(seconds),
+        repeat=repeat,
+    )
+
+
+def commit():
+    proc = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    return proc.stdout.strip() or None
+
+
+def run(config, names, repeat=5, seed=0) -> dict:
+    """Run benchmarks `names` on synthetic data of size `config`, returns the baseline"""
+    results = dict()
+    with tempfile.TemporaryDirectory() as folder:
+        paths = synthetic.write_sources(
+            Path(folder) / "data",
+            config["days"],
+            config["regions"],
+            config["countries"],
+            seed,
+        )
+        data_loading.DATA.update(paths)
+        data_loading.CACHE = DataCache(
+            Path(folder) / "cache", ttl=None, max_entries=None
+        )
+        for name in names:
+            results[name] = measure(BENCHMARKS[name](config), repeat)
+            print(f"{name:<30} {results[name]['median'] * 1000:10.1f}ms")
+    return dict(
+        commit=commit(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        pandas=pd.__version__,
+        machine=platform.platform(),
+        config=dict(config, seed=seed),
+        results=results,
+    )
+
+
+def compare(baseline, current, threshold=0.25) -> list:
+    """Print median times of both runs, returns the names of benchmarks slower than the
+    baseline by more than `threshold` (relative)"""
+    if baseline["config"] != current["config"]:
+        print(f"Warning: baseline was run with {baseline['config']}")
+    print(
+        f"{'':<30} {baseline['commit'] or 'baseline':>12} {current['commit'] or 'current':>12}"
+    )
+    slower = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before, after = baseline["results"][name]["median"], result["median"]
+        change = after / before - 1
+        flag = ""
+        if change > threshold:
+            slower.append(name)
+            flag = "  slower"
+        print(
+            f"{name:<30} {before * 1000:10.1f}ms {after * 1000:10.1f}ms {change:+8.1%}{flag}"
+        )
+    return slower
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    for size in SCALES["small"]:
+        parser.add_argument(f"--{size}", type=int, help="overrides the scale")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("-k", dest="pattern", help="only benchmarks containing this")
+    parser.add_argument("--save", type=Path, help="write results to this JSON file")
+    parser.add_argument("--compare", type=Path, help="baseline JSON file")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument(
+        "--check", action="store_true", help="check results instead of timing"
+    )
+    args = parser.parse_args(args)
+
+    config = dict(SCALES[args.scale])
+    config.update({k: getattr(args, k) for k in config if getattr(args, k) is not None})
+    if args.check:
+        failed = check(config, args.seed)
+        for case in failed:
+            print(f"Different from the reference: {case}")
+        return 1 if failed else 0
+    names = [n for n in BENCHMARKS if not args.pattern or args.pattern in n]
+    print(f"{args.scale}: {config}")
+    current = run(config, names, args.repeat, args.seed)
+
+    if args.save:
+        args.save.write_text(json.dumps(current, indent=1))
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        slower = compare(baseline, current, args.threshold)
+        if slower:
+            print(f"Slower than baseline: {', '.join(slower)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,267 @@
+# %%
+"""Deterministic synthetic data in the shape of the real sources, at any scale.
+
+Same `seed` and sizes give the same files, s.t. benchmark results can be compared
+across commits without network access.
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from data_loading import AT_AGE_GROUPS, D1, D2, Sources, age_brackets
+
+START = "2021-01-01"
+
+# `get_vaccinations_at` selects these regions by name, more regions are added as "Region <n>"
+AT_REGIONS = [
+    "Österreich",
+    "Burgenland",
+    "Kärnten",
+    "Niederösterreich",
+    "Oberösterreich",
+    "Salzburg",
+    "Steiermark",
+    "Tirol",
+    "Vorarlberg",
+    "Wien",
+]
+
+# Age groups of the CDC data, rows before the first one are dropped by `get_death_distr_by_age_us`
+CDC_AGE_GROUPS = [
+    "All Ages",
+    "Under 1 year",
+    "0-17 years",
+    "1-4 years",
+    "5-14 years",
+    "15-24 years",
+    "18-29 years",
+    "25-34 years",
+    "30-39 years",
+    "35-44 years",
+    "40-49 years",
+    "45-54 years",
+    "50-64 years",
+    "55-64 years",
+    "65-74 years",
+    "75-84 years",
+    "85 years and over",
+]
+
+UN_COLUMNS = [
+    "Under 15 years old (UNWPP, 2017)",
+    "Working age (15-64 years old) (UNWPP, 2017)",
+    "65+ years old (UNWPP, 2017)",
+    "Under 5 years old (UNWPP, 2017)",
+    "5-14 years old (UNWPP, 2017)",
+    "15-24 years old (UNWPP, 2017)",
+    "25-64 years old (UNWPP, 2017)",
+]
+
+
+def country_names(n):
+    """ "United States" (the reference of `get_death_data_by_age`) and n - 1 made up countries"""
+    return ["United States"] + [f"Country {i:04d}" for i in range(1, n)]
+
+
+def at_timeline(days=180, regions=10, seed=0) -> pd.DataFrame:
+    """Cumulative vaccinations per region, age group, sex and dose like the AT timeline.
+    `regions` must be at least 10, the Austrian regions come first."""
+    if regions < len(AT_REGIONS):
+        raise ValueError(f"at least {len(AT_REGIONS)} regions are needed")
+    rng = np.random.default_rng(seed)
+    names = AT_REGIONS + [f"Region {i}" for i in range(regions - len(AT_REGIONS))]
+    groups = [
+        f"Gruppe_{grp}_{sex}_{d}"
+        for d in "12"
+        for grp in AT_AGE_GROUPS.values()
+        for sex in "MWD"
+    ]
+    population = rng.integers(100_000, 2_000_000, regions)
+    rate = rng.uniform(0, 1e-3, (regions, 1, len(groups))) * population[:, None, None]
+    cum = rng.poisson(rate, (regions, days, len(groups))).cumsum(axis=1)
+    d1 = cum[:, :, : len(groups) // 2].sum(axis=-1).ravel()
+    d2 = cum[:, :, len(groups) // 2 :].sum(axis=-1).ravel()
+    pop = np.repeat(population, days)
+
+    df = pd.DataFrame(
+        {
+            "Datum": np.tile(
+                pd.date_range(START, periods=days).strftime("%Y-%m-%d"), regions
+            ),
+            "BundeslandID": np.repeat(np.arange(regions), days),
+            "Bevölkerung": pop,
+            "Name": np.repeat(names, days),
+            "EingetrageneImpfungen": d1 + d2,
+            "EingetrageneImpfungenPro100": ((d1 + d2) / pop * 100).round(2),
+            "Teilgeimpfte": d1 - d2,
+            "TeilgeimpftePro100": ((d1 - d2) / pop * 100).round(2),
+            "Vollimmunisierte": d2,
+            "VollimmunisiertePro100": (d2 / pop * 100).round(2),
+        }
+    )
+    return pd.concat(
+        [df, pd.DataFrame(cum.reshape(-1, len(groups)), columns=groups)], axis=1
+    )
+
+
+def owid_daily(columns, days=365, countries=200, seed=0) -> pd.DataFrame:
+    """One row per country and day with random daily numbers in `columns` (name -> mean)"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "location": np.repeat(country_names(countries), days),
+            "iso_code": np.repeat([f"C{i:04d}" for i in range(countries)], days),
+            "date": np.tile(
+                pd.date_range(START, periods=days).strftime("%Y-%m-%d"), countries
+            ),
+        }
+    )
+    for column, mean in columns.items():
+        df[column] = rng.gamma(2, mean / 2, len(df)).round(1)
+    return df
+
+
+def owid_vaccinations(days=365, countries=200, seed=0) -> pd.DataFrame:
+    df = owid_daily(
+        {"daily_vaccinations": 50_000, "daily_vaccinations_per_million": 3_000},
+        days,
+        countries,
+        seed,
+    )
+    df["total_vaccinations"] = df.groupby("location")["daily_vaccinations"].cumsum()
+    return df
+
+
+def owid_deaths(days=365, countries=200, seed=0) -> pd.DataFrame:
+    df = owid_daily(
+        {"new_deaths": 50, "new_deaths_smoothed": 50, "new_cases": 5_000},
+        days,
+        countries,
+        seed + 1,
+    )
+    df["total_deaths"] = df.groupby("location")["new_deaths"].cumsum()
+    return df
+
+
+def owid_population(countries=200, seed=0) -> pd.DataFrame:
+    """Population by age group (UN data as published by OWID), 2019 and 2020"""
+    rng = np.random.default_rng(seed + 2)
+    size = rng.integers(100_000, 100_000_000, countries)
+    shares = rng.dirichlet([2, 3, 10, 4], countries)  # 0-4, 5-14, 15-24, 25-64
+    shares = np.column_stack([shares * 0.85, np.full(countries, 0.15)])
+    under_5, to_14, to_24, to_64, over_64 = (shares * size[:, None]).round().T
+    rows = pd.DataFrame(
+        dict(
+            zip(
+                UN_COLUMNS,
+                [
+                    under_5 + to_14,
+                    to_24 + to_64,
+                    over_64,
+                    under_5,
+                    to_14,
+                    to_24,
+                    to_64,
+                ],
+            )
+        )
+    )
+    rows.insert(0, "Entity", country_names(countries))
+    return pd.concat(
+        [rows.assign(Year=2019), rows.assign(Year=2020)], ignore_index=True
+    )
+
+
+def cdc_deaths_by_age(seed=0) -> pd.DataFrame:
+    """COVID deaths per age group in the US like the CDC data"""
+    rng = np.random.default_rng(seed + 3)
+    deaths = np.sort(rng.integers(10, 100_000, len(CDC_AGE_GROUPS)))
+    return pd.DataFrame(
+        {
+            "Group": "By Year",
+            "Year": 2020,
+            "State": "United States",
+            "Sex": "All Sexes",
+            "Age Group": CDC_AGE_GROUPS,
+            "COVID-19 Deaths": deaths,
+        }
+    )
+
+
+def write_sources(folder, days=180, regions=10, countries=200, seed=0) -> dict:
+    """Write all synthetic sources to `folder`, returns source -> path (see `data_loading.DATA`)"""
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    files = {
+        Sources.VaccAt: (
+            "timeline-eimpfpass.csv",
+            at_timeline(days, regions, seed),
+            dict(sep=";", encoding="utf-8-sig"),
+        ),
+        Sources.Vaccinations: (
+            "vaccinations.csv",
+            owid_vaccinations(days, countries, seed),
+            {},
+        ),
+        Sources.Deaths: ("owid-covid-data.csv", owid_deaths(days, countries, seed), {}),
+        Sources.Demographics: (
+            "owid-population.csv",
+            owid_population(countries, seed),
+            {},
+        ),
+        Sources.DeathsByAge: ("death_count_by_age.csv", cdc_deaths_by_age(seed), {}),
+    }
+    paths = dict()
+    for source, (name, df, kwargs) in files.items():
+        paths[source] = folder / name
+        df.to_csv(paths[source], index=False, **kwargs)
+    return paths
+
+
+# %% Inputs of the engines
+def age_groups(n):
+    """Names of n age brackets covering 0-99"""
+    bounds = np.linspace(0, 100, n + 1).round().astype(int)
+    return [f"{lower:02d}-{upper - 1:02d}" for lower, upper in zip(bounds, bounds[1:])]
+
+
+def priorities(groups):
+    """Priority order like `PRIORITIES` for any age groups, low to high priority:
+    second doses of young groups first, first doses of old groups last"""
+    order = [(d, grp) for d in [D1, D2] for grp in groups]
+    lower = age_brackets(groups)
+    return sorted(order, key=lambda c: lower[c[1]][0] + (30 if c[0] == D1 else 0))
+
+
+def vaccinations(days=180, groups=8, regions=1, seed=0):
+    """Daily doses per age group like `get_vaccinations_at` and population like
+    `get_demographics_at`, returns (df, population)"""
+    rng = np.random.default_rng(seed + 4)
+    names = age_groups(groups) if isinstance(groups, int) else list(groups)
+    regions = [f"Region {i}" for i in range(regions)]
+    population = pd.DataFrame(
+        rng.integers(50_000, 500_000, (len(names), len(regions))),
+        index=names,
+        columns=regions,
+    )
+    # doses per day roughly so that everyone could be vaccinated once within `days`
+    rate = population.to_numpy().sum(axis=0) / days / len(names)
+    doses = rng.poisson(rate[:, None, None], (len(regions), days, 2 * len(names)))
+    columns = pd.MultiIndex.from_tuples(
+        [(r, d, grp) for r in regions for d in [D1, D2] for grp in names]
+    )
+    df = pd.DataFrame(
+        doses.transpose(1, 0, 2).reshape(days, -1),
+        index=pd.date_range(START, periods=days, name="Date"),
+        columns=columns,
+    )
+    return df, population
+
+
+# %%
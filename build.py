@@ -0,0 +1,158 @@
+# %%
+import hashlib
+import inspect
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utility import atomic_write
+
+# Functions and classes defined below this folder are followed when hashing a function
+ROOT = Path(__file__).resolve().parent
+
+
+def fingerprint(*parts) -> str:
+    """Hash of `parts`. DataFrames, Series and arrays are hashed by content, functions by
+    their source code, default arguments and everything of this repo they use (functions,
+    classes and module-level values like `PRIORITIES`), everything else by its repr."""
+    return hashlib.sha1(_digest(parts)).hexdigest()[:16]
+
+
+def _digest(x, seen=None) -> bytes:
+    if isinstance(x, pd.DataFrame):
+        rows = pd.util.hash_pandas_object(x).to_numpy()
+        return repr(list(x.columns)).encode() + rows.tobytes()
+    if isinstance(x, pd.Series):
+        return (
+            repr(x.name).encode() + pd.util.hash_pandas_object(x).to_numpy().tobytes()
+        )
+    if isinstance(x, np.ndarray):
+        return repr((x.shape, x.dtype.str)).encode() + np.ascontiguousarray(x).tobytes()
+    if inspect.isfunction(x) or inspect.isclass(x):
+        return b"\n".join(_sources(x, set() if seen is None else seen))
+    if isinstance(x, (list, tuple)):
+        return b"(" + b",".join(_digest(y, seen) for y in x) + b")"
+    if isinstance(x, (set, frozenset)):
+        return b"{" + b",".join(sorted(_digest(y, seen) for y in x)) + b"}"
+    if isinstance(x, dict):
+        items = sorted(x.items(), key=lambda kv: repr(kv[0]))
+        return (
+            b"{"
+            + b",".join(_digest(k, seen) + b":" + _digest(v, seen) for k, v in items)
+            + b"}"
+        )
+    if type(x).__repr__ is object.__repr__:  # repr contains the address
+        return type(x).__qualname__.encode()
+    return repr(x).encode()
+
+
+def _in_repo(x) -> bool:
+    try:
+        return Path(inspect.getsourcefile(x)).resolve().is_relative_to(ROOT)
+    except (OSError, TypeError):  # builtin, or defined in an interactive session
+        return False
+
+
+def _sources(fn, seen):
+    fn = inspect.unwrap(fn)  # decorated functions, e.g. `profiling.profile`
+    seen.add(fn)
+    try:
+        source = inspect.getsource(fn)
+    except (OSError, TypeError):  # e.g. defined in an interactive session
+        source = fn.__code__.co_code.hex() if inspect.isfunction(fn) else ""
+    yield f"{fn.__module__}.{fn.__qualname__}\n{source}".encode()
+    if inspect.isclass(fn):
+        for method in vars(fn).values():
+            method = getattr(method, "__func__", method)  # static and class methods
+            if inspect.isfunction(method) and method not in seen:
+                yield from _sources(method, seen)
+        return
+    yield _digest((fn.__defaults__, fn.__kwdefaults__), seen)
+    codes, names = [fn.__code__], set()
+    # names used by the function, including nested functions/comprehensions
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes += [c for c in code.co_consts if inspect.iscode(c)]
+    for name in sorted(names):
+        if name not in fn.__globals__:
+            continue  # attribute or builtin
+        g = fn.__globals__[name]
+        if inspect.ismodule(g):
+            # attributes of modules of this repo, e.g. `data_loading.DATA`
+            if _in_repo(g):
+                for attr in sorted(names):
+                    if hasattr(g, attr):
+                        yield from _used(f"{name}.{attr}", getattr(g, attr), seen)
+        else:
+            yield from _used(name, g, seen)
+
+
+def _used(name, g, seen):
+    # global `g` used by a function: functions and classes of this repo are followed,
+    # those of other packages are left out, values are hashed
+    g = inspect.unwrap(g) if callable(g) else g
+    if inspect.isfunction(g) or inspect.isclass(g):
+        if _in_repo(g) and g not in seen:
+            yield from _sources(g, seen)
+    elif not inspect.ismodule(g) and not inspect.isroutine(g):
+        yield name.encode() + b"=" + _digest(g, seen)
+
+
+class TaskGraph:
+    """Incremental build: a task only runs if its fingerprint changed since its last run.
+
+    The fingerprint of a task covers its function, parameters and input data (see `fingerprint`),
+    so a task is outdated as soon as anything upstream of it changes.
+    A task with missing output files is outdated as well.
+    Fingerprints of finished tasks and results of `cached` tasks are kept in `folder`,
+    delete it for a full rebuild. `salt` is part of every fingerprint, e.g. settings or helper
+    functions that all tasks use.
+    """
+
+    def __init__(self, folder, salt=()) -> None:
+        self.folder = Path(folder)
+        self.salt = salt
+        try:
+            self.state = json.loads((self.folder / "state.json").read_text())
+        except (OSError, ValueError):
+            self.state = dict()
+        self.pending = dict()
+        self.stats = {"run": 0, "skipped": 0}
+
+    def outdated(self, name, *parts, outputs=()) -> bool:
+        """Whether task `name` with inputs `parts` has to run, i.e. it changed or one of the files
+        in `outputs` is missing. Call `done` once it ran."""
+        fp = fingerprint(self.salt, *parts)
+        if self.state.get(name) == fp and all(Path(p).exists() for p in outputs):
+            self.stats["skipped"] += 1
+            return False
+        self.pending[name] = fp
+        self.stats["run"] += 1
+        return True
+
+    def done(self, *names):
+        """Mark outdated tasks as finished, all of them if no `names` are given"""
+        for name in names or list(self.pending):
+            self.state[name] = self.pending.pop(name)
+
+    def cached(self, name, fn, *args, **kwargs):
+        """Result of `fn(*args, **kwargs)`, stored and only recalculated if the task is outdated"""
+        path = self.folder / f"{name}.pkl"
+        if not self.outdated(name, fn, args, kwargs, outputs=[path]):
+            return pd.read_pickle(path)
+        result = fn(*args, **kwargs)
+        with atomic_write(path) as f:
+            pd.to_pickle(result, f)
+        self.done(name)
+        return result
+
+    def save(self):
+        """Write the fingerprints of finished tasks"""
+        with atomic_write(self.folder / "state.json") as f:
+            f.write(json.dumps(self.state, indent=1, sort_keys=True).encode())
+
+
+# %%
@@ -0,0 +1,111 @@
+# %%
+import hashlib
+import json
+import os
+import time
+from datetime import timedelta
+from pathlib import Path
+
+import pandas as pd
+
+from utility import atomic_write
+
+# Default of the `ttl` arguments, i.e. use the TTL of the cache (None means no TTL)
+_CACHE_TTL = object()
+
+
+class DataCache:
+    """On-disk cache of DataFrames (parquet files in `folder`).
+
+    - Entries are keyed by name, source and the arguments used to read them.
+    - Entries older than `ttl` are reloaded, `ttl=None` keeps them until evicted.
+    - At most `max_entries` files / `max_bytes` bytes are kept, least recently used ones are removed.
+    - Files are written to a temporary file first and then renamed, s.t. other processes
+        never read half-written files.
+    """
+
+    def __init__(
+        self,
+        folder=Path("./cache"),
+        ttl=timedelta(days=1),
+        max_entries=50,
+        max_bytes=None,
+    ) -> None:
+        self.folder = Path(folder)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def key(self, name, *parts, **kwargs) -> str:
+        """Key from a readable `name` and everything else that identifies an entry"""
+        text = json.dumps(
+            [[str(p) for p in parts], kwargs], sort_keys=True, default=str
+        )
+        digest = hashlib.sha1(text.encode()).hexdigest()[:16]
+        return f"{name}_{digest}"
+
+    def path(self, key) -> Path:
+        return self.folder / f"{key}.pqt"
+
+    def version(self, key, ttl=_CACHE_TTL):
+        """Modification time of entry `key` (changes whenever it is reloaded), None if missing or stale"""
+        ttl = self.ttl if ttl is _CACHE_TTL else ttl
+        try:
+            mtime = self.path(key).stat().st_mtime_ns
+        except OSError:
+            return None
+        age = timedelta(seconds=time.time() - mtime / 1e9)
+        return mtime if ttl is None or age < ttl else None
+
+    def get(self, key, load, ttl=_CACHE_TTL) -> pd.DataFrame:
+        """Return the entry `key`, calls `load()` and stores the result if there is no fresh entry.
+        `ttl` overrides the TTL of the cache for this entry, `ttl=None` keeps it until evicted.
+        """
+        ttl = self.ttl if ttl is _CACHE_TTL else ttl
+        path = self.path(key)
+        try:
+            stat = path.stat()
+            age = timedelta(seconds=time.time() - stat.st_mtime)
+            if ttl is None or age < ttl:
+                df = pd.read_parquet(path)
+                # atime = last use, keep mtime exact as it is the version of the entry
+                os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+                self.stats["hits"] += 1
+                return df
+        except OSError:
+            pass  # missing, or removed by another process in the meantime
+        self.stats["misses"] += 1
+        df = load()
+        self.put(key, df)
+        return df
+
+    def put(self, key, df: pd.DataFrame):
+        with atomic_write(self.path(key)) as f:
+            df.to_parquet(f, compression="gzip")
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the limits are met"""
+        entries = []
+        for path in self.folder.glob("*.pqt"):
+            try:
+                entries.append((path.stat(), path))
+            except FileNotFoundError:
+                continue
+        entries.sort(key=lambda e: e[0].st_atime, reverse=True)  # most recent first
+        kept, total = 0, 0
+        for stat, path in entries:
+            too_many = self.max_entries is not None and kept >= self.max_entries
+            too_big = (
+                self.max_bytes is not None and total + stat.st_size > self.max_bytes
+            )
+            if too_many or (too_big and kept > 0):
+                path.unlink(missing_ok=True)
+                self.stats["evictions"] += 1
+            else:
+                kept += 1
+                total += stat.st_size
+
+
+# %%
@@ -1,10 +1,14 @@
 #%%
-from datetime import datetime
+import functools
+from datetime import timedelta
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 
+from build import fingerprint
+from cache import DataCache
+from profiling import profile, stage
 from utility import fix_multilevel
 
 D0 = "0D"
@@ -24,7 +28,8 @@ class Sources(Enum):
     VaccDe = 7
 
 
-def get_risk_by_age():
+def get_risk_by_age() -> dict:
+    """Risk of dying from COVID relative to 5-17 year olds, by (lowest, highest) age"""
     # data from CDC
     # https://www.cdc.gov/coronavirus/2019-ncov/images/need-extra-precautions/319360-A_COVID-19_RiskForSevereDisease_Race_Age_2.18_p1.jpg
     # tuples denote inclusive ranges
@@ -39,6 +44,7 @@ def get_risk_by_age():
         (75, 84): 2800,  # G
         (85, 99): 7900,  # H
     }
+    return age_risk_factor
 
 
 DATA = {
@@ -58,35 +64,282 @@ DATA = {
 }
 
 
-def get_data_with_cache(name, **kwargs) -> pd.DataFrame:
+# Age groups of the Austrian data and how they are called in the source
+AT_AGE_GROUPS = {
+    "00-24": "<25",
+    "25-34": "25-34",
+    "35-44": "35-44",
+    "45-54": "45-54",
+    "55-64": "55-64",
+    "65-74": "65-74",
+    "75-84": "75-84",
+    "85-99": ">84",
+}
+
+# Age groups of the death data, see `get_death_distr_by_age_us`
+AGE_GROUPS = [
+    "0-4",
+    "5-14",
+    "15-24",
+    "25-34",
+    "35-44",
+    "45-54",
+    "55-64",
+    "65-74",
+    "75-84",
+    "85-99",
+]
+
+# US population by age, used to split up age brackets
+# https://www.census.gov/data/tables/time-series/demo/popest/2010s-national-detail.html
+# basically, assume that age distribution of USA is broadly representative of whole world
+US_POPULATION = {
+    (0, 4): 19576683,
+    (5, 9): 20195895,
+    (10, 14): 20798268,
+    (15, 19): 21054570,
+    (20, 24): 21632940,
+    (25, 29): 23509016,
+    (30, 34): 22431305,
+    (35, 39): 21737521,
+    (40, 44): 19921623,
+    (45, 49): 20397751,
+    (50, 54): 20477151,
+    (55, 59): 21877391,
+    (60, 64): 20571146,
+    (65, 69): 17455001,
+    (70, 74): 14028432,
+    (75, 79): 9652665,
+    (80, 84): 6317207,
+    (85, 99): 6604958,
+}
+
+# Columns (and their types) that are read from each source, other columns are skipped.
+# Everything except `dates` is passed to `pd.read_csv`,
+# `dates` are columns that are parsed with the given format (timestamps are cut to the date).
+SCHEMAS = {
+    Sources.Vaccinations: dict(
+        usecols=[
+            "date",
+            "location",
+            "daily_vaccinations",
+            "daily_vaccinations_per_million",
+        ],
+        dtype={
+            "location": "category",
+            # counts above 2**24 (e.g. China, World) are not exact in float32
+            "daily_vaccinations": "float64",
+            "daily_vaccinations_per_million": "float32",
+        },
+        dates={"date": "%Y-%m-%d"},
+        engine="pyarrow",
+    ),
+    Sources.Deaths: dict(
+        usecols=["date", "location", "new_deaths", "new_deaths_smoothed"],
+        dtype={
+            "location": "category",
+            "new_deaths": "float64",
+            "new_deaths_smoothed": "float32",
+        },
+        dates={"date": "%Y-%m-%d"},
+        engine="pyarrow",
+    ),
+    Sources.DeathsByAge: dict(
+        usecols=["Group", "Year", "State", "Sex", "Age Group", "COVID-19 Deaths"],
+        dtype={"Group": "category", "State": "category", "Sex": "category"},
+    ),
+    Sources.Demographics: dict(
+        usecols=[
+            "Entity",
+            "Year",
+            "Under 15 years old (UNWPP, 2017)",
+            "Working age (15-64 years old) (UNWPP, 2017)",
+            "65+ years old (UNWPP, 2017)",
+            "Under 5 years old (UNWPP, 2017)",
+            "5-14 years old (UNWPP, 2017)",
+            "15-24 years old (UNWPP, 2017)",
+            "25-64 years old (UNWPP, 2017)",
+        ],
+        dtype={"Year": "int16"},
+    ),
+    Sources.VaccAt: dict(
+        sep=";",
+        encoding="utf-8-sig",  # file starts with a BOM
+        usecols=[
+            "Datum",
+            "Bevölkerung",
+            "Name",
+            "EingetrageneImpfungen",
+            "EingetrageneImpfungenPro100",
+            "Teilgeimpfte",
+            "Vollimmunisierte",
+            "TeilgeimpftePro100",
+            "VollimmunisiertePro100",
+        ]
+        + [
+            f"Gruppe_{grp}_{sex}_{d}"
+            for d in "12"
+            for grp in AT_AGE_GROUPS.values()
+            for sex in "MWD"
+        ],
+        dtype={"Name": "category"},
+        dates={"Datum": "%Y-%m-%d"},
+    ),
+    Sources.DeathsAtAge: dict(
+        dtype={"Cases": "int32", "Deaths": "int32", "Lethality": "float32"},
+    ),
+    Sources.VaccDe: dict(
+        usecols=["Date", D1, D2],
+        dtype={D1: "int32", D2: "int32"},
+        dates={"Date": "%Y-%m-%d"},
+    ),
+}
+
+# Rows per chunk when reading a filtered source
+FILTER_CHUNK_SIZE = 200_000
+
+# Replace to change location, TTL or size of the cache
+CACHE = DataCache(Path("./cache"), ttl=timedelta(days=1), max_entries=50)
+
+
+def _raw_key(name, **kwargs):
+    # cache key and TTL of raw data
     source = DATA[name]
     if isinstance(source, Path):
-        return pd.read_csv(source, **kwargs)
+        # local files are cached until they change
+        stat = source.stat()
+        key = CACHE.key(name, source, stat.st_mtime_ns, stat.st_size, **kwargs)
+        return key, None
     elif isinstance(source, str):
-        today = datetime.now().date().strftime("%Y-%m-%d")
-        path = Path(f"./cache/{name}_{today}.pqt")
-        if path.exists():
-            df_raw = pd.read_parquet(path)
-        else:
-            df_raw = pd.read_csv(source, **kwargs)
-            df_raw.to_parquet(path, compression="gzip")
-        return df_raw
+        return CACHE.key(name, source, **kwargs), CACHE.ttl
     else:
         raise Exception("Source must be either string or Path")
 
 
-def get_vaccination_data(extend_by_days=0, per_million=True) -> pd.DataFrame:
+def _parse_dates(df, dates):
+    for column, date_format in (dates or {}).items():
+        if not pd.api.types.is_datetime64_any_dtype(df[column]):
+            dates = df[column].astype(str).str.slice(0, 10)
+            df[column] = pd.to_datetime(dates, format=date_format)
+    return df
+
+
+@profile
+def read_source(
+    name, dates=None, locations=None, since=None, until=None, **kwargs
+) -> pd.DataFrame:
+    """Read source without cache, `kwargs` are the schema of the source, see `SCHEMAS`.
+    If `locations` (values of column "location") or a date window (`since`, `until`, inclusive)
+    is given, the file is read in chunks and only matching rows are kept."""
+    if locations is None and since is None and until is None:
+        return _parse_dates(pd.read_csv(DATA[name], **kwargs), dates)
+
+    kwargs["engine"] = "c"  # pyarrow can't read in chunks
+    parts = []
+    for chunk in pd.read_csv(DATA[name], chunksize=FILTER_CHUNK_SIZE, **kwargs):
+        chunk = _parse_dates(chunk, dates)
+        keep = np.ones(len(chunk), dtype=bool)
+        if locations is not None:
+            keep &= chunk["location"].isin(locations).to_numpy()
+        for column in dates or {}:
+            if since is not None:
+                keep &= (chunk[column] >= pd.Timestamp(since)).to_numpy()
+            if until is not None:
+                keep &= (chunk[column] <= pd.Timestamp(until)).to_numpy()
+        parts.append(chunk[keep])
+    # categories differ between chunks, restore types after joining them
+    return pd.concat(parts, ignore_index=True).astype(kwargs.get("dtype", {}))
+
+
+def get_data_with_cache(name, **kwargs) -> pd.DataFrame:
+    kwargs = {**SCHEMAS.get(name, {}), **kwargs}
+    key, ttl = _raw_key(name, **kwargs)
+    with stage(f"get_data_with_cache({name.name})") as record:
+        return record.output(
+            CACHE.get(key, lambda: read_source(name, **kwargs), ttl=ttl)
+        )
+
+
+def get_raw_version(name, **kwargs) -> str:
+    """Identifies the raw data `get_data_with_cache(name, **kwargs)` returns, loads it if not cached"""
+    key, ttl = _raw_key(name, **SCHEMAS.get(name, {}), **kwargs)
+    version = CACHE.version(key, ttl)
+    if version is None:
+        get_data_with_cache(name, **kwargs)
+        version = CACHE.version(key, ttl)
+    return f"{key}@{version}"
+
+
+def get_filters(locations=None, since=None, until=None) -> dict:
+    """Arguments for filtered reads of `get_data_with_cache`, unused filters are left out"""
+    filters = dict()
+    if locations is not None:
+        filters["locations"] = sorted(locations)
+    if since is not None:
+        filters["since"] = str(pd.Timestamp(since).date())
+    if until is not None:
+        filters["until"] = str(pd.Timestamp(until).date())
+    return filters
+
+
+def memoize(*sources):
+    """Cache the DataFrame returned by the decorated function.
+    Results are keyed by the function (see `build.fingerprint`), its arguments and the raw data
+    of `sources`, i.e. they are recalculated once the code or one of the sources is updated.
+    Keyword arguments of `get_filters` also filter the raw data."""
+
+    def decorator(fn):
+        # hashed on first use, once the functions it calls are defined
+        code = functools.cache(lambda: fingerprint(fn))
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            filters = get_filters(
+                **{k: kwargs.get(k) for k in ["locations", "since", "until"]}
+            )
+            with stage(fn.__name__) as record:
+                versions = [get_raw_version(s, **filters) for s in sources]
+                key = CACHE.key(fn.__name__, code(), *versions, args=args, **kwargs)
+                df = CACHE.get(key, lambda: fn(*args, **kwargs), ttl=None)
+                return record.output(df)
+
+        return wrapper
+
+    return decorator
+
+
+def _pivot_daily(df_raw, column, locations=None) -> pd.DataFrame:
+    """`column` of the raw OWID data, one row per day (missing days are NaN) and location.
+    Raises a ValueError if some `locations` or all data are missing."""
+    if locations is not None:
+        missing = sorted(set(locations) - set(df_raw["location"].astype(str)))
+        if missing:
+            raise ValueError(f"No data for locations: {', '.join(missing)}")
+    if df_raw.empty:
+        raise ValueError("No data in the selected date window")
+    df = df_raw.pivot(index="date", columns="location", values=column)
+    df.columns = df.columns.astype(str)  # categorical -> str
+    # other locations may report on days the selected ones don't, rows must be consecutive days
+    return df.reindex(pd.date_range(df.index.min(), df.index.max(), name="date"))
+
+
+@memoize(Sources.Vaccinations)
+def get_vaccination_data(
+    extend_by_days=0, per_million=True, *, locations=None, since=None, until=None
+) -> pd.DataFrame:
     """Load data from CSV and prepare it for use
 
     Args:
         extend_by_days (int, optional): Add days at end of DF, must be >= 0
+        locations (list, optional): Only load these locations
+        since, until (optional): Only load days in this window
     """
-    df_raw = get_data_with_cache(Sources.Vaccinations)
-    df_raw["date"] = pd.to_datetime(df_raw["date"])
+    filters = get_filters(locations, since, until)
+    df_raw = get_data_with_cache(Sources.Vaccinations, **filters)
     vac_pp_col = (
         "daily_vaccinations_per_million" if per_million else "daily_vaccinations"
     )
-    df = df_raw.pivot(index="date", columns="location", values=vac_pp_col)
+    df = _pivot_daily(df_raw, vac_pp_col, locations)
     df = df.fillna(0)
     # Add additional rows on bottom
     start = df.index.max()
@@ -96,12 +349,15 @@ def get_vaccination_data(extend_by_days=0, per_million=True) -> pd.DataFrame:
     return df
 
 
-def get_death_data(extend_by_days=0, smoothed=True) -> pd.DataFrame:
+@memoize(Sources.Deaths)
+def get_death_data(
+    extend_by_days=0, smoothed=True, *, locations=None, since=None, until=None
+) -> pd.DataFrame:
     # Smoothed data should lessen artifacts from data-reporting delays
     death_column = "new_deaths_smoothed" if smoothed else "new_deaths"
-    df_raw = get_data_with_cache(Sources.Deaths)
-    df_raw["date"] = pd.to_datetime(df_raw["date"])
-    df = df_raw.pivot(index="date", columns="location", values=death_column)
+    filters = get_filters(locations, since, until)  # see get_vaccination_data
+    df_raw = get_data_with_cache(Sources.Deaths, **filters)
+    df = _pivot_daily(df_raw, death_column, locations)
     df = df.fillna(0)
     # Add additional rows on bottom
     start = df.index.max()
@@ -162,7 +418,65 @@ def get_death_distr_by_age_us() -> pd.DataFrame:
     return df
 
 
-def get_age_data() -> pd.DataFrame:
+def age_brackets(names) -> dict:
+    """Age brackets from their names, e.g. "25-34" -> (25, 34). Single ages are also allowed."""
+    brackets = dict()
+    for name in names:
+        lower, _, upper = str(name).partition("-")
+        brackets[name] = (int(lower), int(upper or lower))
+    return brackets
+
+
+def age_membership(brackets, oldest) -> np.ndarray:
+    """1 if an age (columns, 0 to `oldest`) is in a bracket (rows), see `age_brackets`"""
+    m = np.zeros((len(brackets), oldest + 1))
+    for i, (lower, upper) in enumerate(brackets.values()):
+        m[i, lower : upper + 1] = 1
+    return m
+
+
+def age_profile(profile, oldest) -> np.ndarray:
+    """People per age from the population per (lowest, highest) age, e.g. `US_POPULATION`"""
+    people = np.zeros(oldest + 1)
+    for (lower, upper), n in profile.items():
+        people[lower : upper + 1] = n / (upper - lower + 1)
+    return people
+
+
+def rebinning_matrix(source, target, profile=None) -> pd.DataFrame:
+    """Weights to move counts from `source` to `target` age brackets, see `rebin`.
+
+    Args:
+    - source, target: Dicts of bracket name -> (lowest, highest) age, see `age_brackets`.
+    - profile: Population per (lowest, highest) age, used to split source brackets that overlap
+        several target brackets. Defaults to the same number of people for each age.
+
+    Returns:
+        pd.DataFrame: Share of each source bracket (index) in each target bracket (columns)
+    """
+    oldest = max(upper for _, upper in [*source.values(), *target.values()])
+    people = np.ones(oldest + 1) if profile is None else age_profile(profile, oldest)
+    weights = age_membership(source, oldest) * people
+    weights /= weights.sum(axis=1, keepdims=True)
+    return pd.DataFrame(
+        weights @ age_membership(target, oldest).T,
+        index=list(source),
+        columns=list(target),
+    )
+
+
+def rebin(df, matrix) -> pd.DataFrame:
+    """Change the age brackets (columns) of `df`, `matrix` is from `rebinning_matrix`"""
+    return df[matrix.index] @ matrix
+
+
+# Age brackets of the UN population data, see `get_age_data_un`
+UN_AGE_GROUPS = ["0-4", "5-14", "15-24", "25-64", "65-99"]
+
+
+@memoize(Sources.Demographics)
+def get_age_data_un() -> pd.DataFrame:
+    """Population per location (index) in the age brackets `UN_AGE_GROUPS` (columns)"""
     #%% get raw data from owid (source is UN afaik)
     df = get_data_with_cache(Sources.Demographics)
     df = df[df.Year == 2020]
@@ -178,88 +492,65 @@ def get_age_data() -> pd.DataFrame:
         "25-64 years old (UNWPP, 2017)": "25-64",
     }
     df = df.rename(rename, axis=1)
-    # age brackets don't match with population data, use data from USA to split up groups
-    # https://www.census.gov/data/tables/time-series/demo/popest/2010s-national-detail.html
-    # basically, assume that age distribution of USA is broadly representative of whole world
-    age_factors = {  # each letter group sums up to 1
-        "0-4": {(0, 4): 19576683 / 19576683},  # A
-        "5-14": {  # B
-            (5, 9): 20195895 / 40994163,
-            (10, 14): 20798268 / 40994163,
-        },
-        "15-24": {  # C
-            (15, 19): 21054570 / 42687510,
-            (20, 24): 21632940 / 42687510,
-        },
-        "25-64": {  # D
-            (25, 29): 23509016 / 170922904,
-            (30, 34): 22431305 / 170922904,
-            (35, 39): 21737521 / 170922904,
-            (40, 44): 19921623 / 170922904,
-            (45, 49): 20397751 / 170922904,
-            (50, 54): 20477151 / 170922904,
-            (55, 59): 21877391 / 170922904,
-            (60, 64): 20571146 / 170922904,
-        },
-        "65-99": {  # E
-            (65, 69): 17455001 / 54058263,
-            (70, 74): 14028432 / 54058263,
-            (75, 79): 9652665 / 54058263,
-            (80, 84): 6317207 / 54058263,
-            (85, 99): 6604958 / 54058263,
-        },
-    }
-    # rearrange and drop useless stuff
-    new_groups = {"Location": df["Location"]}
-    for group, subgroups in age_factors.items():
-        for (lower, upper), factor in subgroups.items():
-            new_groups[f"{lower}-{upper}"] = (df[group] * factor).astype(int)
-    # as death data 10y intervals, recalculate those brackets:
-    df = pd.DataFrame(new_groups).set_index("Location")
-    ages_new_brackets = {
-        "0-4": ["0-4"],
-        "5-14": ["5-9", "10-14"],
-        "15-24": ["15-19", "20-24"],
-        "25-34": ["25-29", "30-34"],
-        "35-44": ["35-39", "40-44"],
-        "45-54": ["45-49", "50-54"],
-        "55-64": ["55-59", "60-64"],
-        "65-74": ["65-69", "70-74"],
-        "75-84": ["75-79", "80-84"],
-        "85-99": ["85-99"],
-    }
-    return pd.DataFrame({k: df[v].sum(axis=1) for k, v in ages_new_brackets.items()})
+    return df.set_index("Location")[UN_AGE_GROUPS]
+
+
+@memoize(Sources.Demographics)
+def get_age_data(groups=tuple(AGE_GROUPS)) -> pd.DataFrame:
+    # age brackets don't match with the death data, use data from USA to split up groups
+    source = age_brackets(UN_AGE_GROUPS)
+    matrix = rebinning_matrix(source, age_brackets(groups), US_POPULATION)
+    return rebin(get_age_data_un(), matrix).round().astype(int)
+
+
+def death_shares_by_age(age, us_death_shares, us) -> np.ndarray:
+    """Share of deaths per age group of each location, the US shares scaled by the population
+    share of each group relative to the US.
+
+    Args:
+    - age: Population, shape (..., locations, groups).
+    - us_death_shares: Share of deaths per age group in the US, shape (groups,).
+    - us: Position of the US in the locations.
+    """
+    age_distr = age / age.sum(axis=-1, keepdims=True)  # percentage in each bracket
+    # not sure if this is a good idea
+    relative_to_us = age_distr / age_distr[..., us : us + 1, :]
+    x = relative_to_us * us_death_shares
+    return x / x.sum(axis=-1, keepdims=True)
 
 
 #%%
+@memoize(Sources.DeathsByAge, Sources.Deaths, Sources.Demographics)
 def get_death_data_by_age() -> pd.DataFrame:
     death_distr = get_death_distr_by_age_us().transpose().loc["DeathShare"]
     deaths = get_death_data()
     age = get_age_data()
-    age_t = age.transpose()
 
-    us_distribution = age_t["United States"] / age_t["United States"].sum()
-    countries = set(age.index) & set(deaths.columns)
+    countries = [c for c in age.index if c in deaths.columns]
     # Mostly small countries are missing, but also:
     # - Czechia, because it's sometimes called Czech Republic
     # - Serbia ?
     # - Kosovo ?
-    columns = dict()
-    for country in countries:
-        age_distr = age_t[country] / age_t[country].sum()  # percentage in each bracket
-        relative_to_us = age_distr / us_distribution  # not sure if this is a good idea
-        x = relative_to_us * death_distr
-        death_distr_x = x / x.sum()
-        for group in death_distr_x.index:
-            columns[(country, group)] = deaths[country] * death_distr_x[group]
-        columns
-    return pd.DataFrame(columns)
+    shares = death_shares_by_age(
+        age.to_numpy(dtype=float),
+        death_distr[age.columns].to_numpy(dtype=float),
+        age.index.get_loc("United States"),
+    )
+    death_distr_x = pd.DataFrame(shares, index=age.index, columns=age.columns)
+    death_distr_x = death_distr_x.loc[countries]  # countries x groups
+
+    # days x countries x groups, in the precision of the death data
+    values = deaths[countries].to_numpy()
+    block = values[:, :, None] * death_distr_x.to_numpy(dtype=values.dtype)
+    columns = pd.MultiIndex.from_product([countries, death_distr_x.columns])
+    return pd.DataFrame(
+        block.reshape(len(deaths), -1), index=deaths.index, columns=columns
+    )
 
 
 #%%
 def get_vaccinations_de():
-    df = get_data_with_cache(Sources.VaccDe, parse_dates=True)
-    df["Date"] = pd.to_datetime(df["Date"].str.slice(0, 10))
+    df = get_data_with_cache(Sources.VaccDe)
     df = df.set_index("Date", drop=True)
     # De doesn't publish data by age group
     columns = {
@@ -276,12 +567,12 @@ def get_vaccinations_de():
     return df[cs]
 
 
-get_vaccinations_de()
 #%%
 #%%
+@memoize(Sources.VaccAt)
 def get_vaccinations_at(filter_region=None):
     clean_special_chars = lambda x: x.replace("\ufeff", "")
-    df = get_data_with_cache(Sources.VaccAt, sep=";", parse_dates=True)
+    df = get_data_with_cache(Sources.VaccAt)
     df.columns = map(clean_special_chars, df.columns)
     # Remove BOM from first column
 
@@ -305,10 +596,8 @@ def get_vaccinations_at(filter_region=None):
         "VollimmunisiertePro100": "Vacc_2Per100",
     }
     df = df.rename(translate, axis=1)
-    df["Date"] = pd.to_datetime(df["Date"].str.slice(0, 10))
 
     relevant = [
-        "Date",
         "Population",
         "Vacc",
         "VaccPer100",
@@ -318,48 +607,27 @@ def get_vaccinations_at(filter_region=None):
         "Vacc_2Per100",
     ]
 
-    df_full = df.copy()
-    regions = dict()
-    for region in df.Region.unique():
-        df = df_full[df_full.Region == region]
-        groups = {
-            D1: {
-                "00-24": ["Gruppe_<25_M_1", "Gruppe_<25_W_1", "Gruppe_<25_D_1"],
-                "25-34": ["Gruppe_25-34_M_1", "Gruppe_25-34_W_1", "Gruppe_25-34_D_1"],
-                "35-44": ["Gruppe_35-44_M_1", "Gruppe_35-44_W_1", "Gruppe_35-44_D_1"],
-                "45-54": ["Gruppe_45-54_M_1", "Gruppe_45-54_W_1", "Gruppe_45-54_D_1"],
-                "55-64": ["Gruppe_55-64_M_1", "Gruppe_55-64_W_1", "Gruppe_55-64_D_1"],
-                "65-74": ["Gruppe_65-74_M_1", "Gruppe_65-74_W_1", "Gruppe_65-74_D_1"],
-                "75-84": ["Gruppe_75-84_M_1", "Gruppe_75-84_W_1", "Gruppe_75-84_D_1"],
-                "85-99": ["Gruppe_>84_M_1", "Gruppe_>84_W_1", "Gruppe_>84_D_1"],
-            },
-            D2: {
-                "00-24": ["Gruppe_<25_M_2", "Gruppe_<25_W_2", "Gruppe_<25_D_2"],
-                "25-34": ["Gruppe_25-34_M_2", "Gruppe_25-34_W_2", "Gruppe_25-34_D_2"],
-                "35-44": ["Gruppe_35-44_M_2", "Gruppe_35-44_W_2", "Gruppe_35-44_D_2"],
-                "45-54": ["Gruppe_45-54_M_2", "Gruppe_45-54_W_2", "Gruppe_45-54_D_2"],
-                "55-64": ["Gruppe_55-64_M_2", "Gruppe_55-64_W_2", "Gruppe_55-64_D_2"],
-                "65-74": ["Gruppe_65-74_M_2", "Gruppe_65-74_W_2", "Gruppe_65-74_D_2"],
-                "75-84": ["Gruppe_75-84_M_2", "Gruppe_75-84_W_2", "Gruppe_75-84_D_2"],
-                "85-99": ["Gruppe_>84_M_2", "Gruppe_>84_W_2", "Gruppe_>84_D_2"],
-            },
-        }
-        dfn = df[relevant].copy()
-        # necessary in both
-        df = df.set_index(["Date"]).sort_index()
-        dfn = dfn.set_index(["Date"]).sort_index()
-        for d, g in groups.items():
-            for k, v in g.items():
-                # Sum over m/f/x, derive to get daily numbers, fill up empty with 0
-                dfn[(d, k)] = df[v].sum(axis=1).diff().fillna(0).astype(int)
-
-        dfn.columns = [("Meta", x) if isinstance(x, str) else x for x in dfn.columns]
-        # throw away first row as derivative doesn't really work when multiple regions exist
-        regions[region] = dfn
-    for k, v in regions.items():
-        v.columns = [(k, *x) for x in v.columns]
-    dft = pd.concat(regions.values(), axis=1)
-    dft.columns = pd.MultiIndex.from_tuples(dft.columns)
+    # Gruppe_<age>_<sex>_<dose> -> (dose, group, sex)
+    doses = {"1": D1, "2": D2}
+    age_columns = {
+        f"Gruppe_{src}_{sex}_{n}": (d, grp, sex)
+        for n, d in doses.items()
+        for grp, src in AT_AGE_GROUPS.items()
+        for sex in "MWD"
+    }
+    df = df.set_index(["Region", "Date"]).sort_index()
+    ages = df[list(age_columns)]
+    ages.columns = pd.MultiIndex.from_tuples(
+        age_columns.values(), names=["dose", "group", "sex"]
+    )
+    # Sum over m/f/x, derive per region to get daily numbers, fill up empty with 0
+    daily = ages.stack("sex").groupby(level=["Region", "Date"], observed=True).sum()
+    daily = daily.groupby(level="Region", observed=True).diff().fillna(0).astype(int)
+
+    meta = df[relevant]
+    meta.columns = pd.MultiIndex.from_product([["Meta"], meta.columns])
+    dft = pd.concat([meta, daily], axis=1).unstack("Region")
+    dft.columns = dft.columns.reorder_levels([2, 0, 1])
     selection = dft[
         [
             "Österreich",
@@ -386,28 +654,15 @@ def get_deaths_by_age_at():
 
 
 # %%
-def get_demographics_at():
+def get_demographics_at(groups=tuple(AT_AGE_GROUPS)):
     df = pd.read_excel("data/population-at.xlsx")
     df.columns = [x.strip() for x in df.columns]
-    print(df.columns)
     df = df.rename({"Alter": "Age"}, axis=1)
     df["Age"] = [x.split()[0] for x in df["Age"]]
     df["Age"] = df["Age"].astype(int)
-    df = df.set_index("Age")
-    age_groups = {
-        "00-24": list(range(00, 24 + 1)),
-        "25-34": list(range(25, 34 + 1)),
-        "35-44": list(range(35, 44 + 1)),
-        "45-54": list(range(45, 54 + 1)),
-        "55-64": list(range(55, 64 + 1)),
-        "65-74": list(range(65, 74 + 1)),
-        "75-84": list(range(75, 84 + 1)),
-        "85-99": list(range(85, 99 + 1)),
-    }
-    new_df = pd.DataFrame(columns=df.columns)
-    for k, v in age_groups.items():
-        new_df.loc[k] = df.loc[v].sum()
-    return new_df
+    df = df.set_index("Age").T
+    matrix = rebinning_matrix(age_brackets(df.columns), age_brackets(groups))
+    return rebin(df, matrix).T.round().astype(int)
 
 
 # %%
@@ -1,6 +1,47 @@
+import json
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
 
 from data_loading import D0, D1, D2
+from profiling import profile
+from utility import atomic_write
+
+# This ordering should optimize lives saved according to relative risk of each age group
+# releasec by the CDC
+# https://www.cdc.gov/coronavirus/2019-ncov/images/need-extra-precautions/319360-A_COVID-19_RiskForSevereDisease_Race_Age_2.18_p1.jpg
+# Sorted from low priority to high priority
+PRIORITIES = [
+    (D2, "00-24"),
+    (D2, "25-34"),
+    (D2, "35-44"),
+    (D1, "00-24"),
+    (D2, "55-64"),
+    (D1, "25-34"),
+    (D2, "45-54"),
+    (D1, "35-44"),
+    (D2, "65-74"),
+    (D1, "45-54"),
+    (D2, "75-84"),
+    (D1, "55-64"),
+    (D1, "65-74"),
+    (D2, "85-99"),
+    (D1, "75-84"),
+    (D1, "85-99"),
+]
+
+# Fraction of a full dose that is given to each age group with fractional dosing
+FRACTIONAL_DOSES = {
+    "00-24": 0.25,
+    "25-34": 0.25,
+    "35-44": 0.25,
+    "45-54": 0.25,
+    "55-64": 0.5,
+    "65-74": 0.75,
+    "75-84": 1,
+    "85-99": 1,
+}
 
 
 #%% Calculate alternative dose-distribution
@@ -10,12 +51,24 @@ from data_loading import D0, D1, D2
 # to give a vaccination to someone that is from a group that benefits most from it
 # 95 - 89 = 6, i.e. 2nd dose is roughly 15x less effective
 # if X has a 15x higher risk of dying from COVID than Y, it's better to give X a second dose vs Y a first dose.
+@profile
 def redistribute_doses(
-    df, pop, *, distr_first=False, priority=None, fractional_dosing=False
+    df,
+    pop,
+    *,
+    distr_first=False,
+    priority=None,
+    fractional_dosing=False,
+    fractional_doses=None,
 ) -> pd.DataFrame:
     """Distribute doses according to priority, s.t. lives saved is maximized.
     Total number of vaccinations for each day does not change (as it is assumed that this is limited by capacity/supply).
 
+    Same semantics as `redistribute_doses_pandas`, but the dose counters live in flat arrays indexed
+    by column position and the priority queue is a pointer into the priority order instead of a list
+    that is mutated in the loop. Doses that are left over once every group is fully vaccinated
+    are dropped (the reference implementation fails with an IndexError in that case).
+
     Args:
     - df pd.DataFrame: Dataframe with index = Date and columns with number of vaccinations per day and age group.
         An example column would have the "Name" `(D1, "25-34")`. Age groups from 25-34 to 75-84 and then 85-99.
@@ -25,45 +78,139 @@ def redistribute_doses(
         doses for younger people were given to at-risk groups.
     - priority: List of columns from `df` in priority order (which group should be vaccinated first).
         Sort from low priority to high priority
+    - fractional_dosing: Give fractional doses to younger groups, the saved doses go to the next group.
+    - fractional_doses: Fraction of a dose per age group, defaults to `FRACTIONAL_DOSES`.
 
     Returns:
         pd.DataFrame: Returns a DF with the same dimensions and columns as `df` but with vaccines
         redistributed for higher life-saving-potential
     """
-    have_d = df.iloc[0].copy() * 0  # Have 1 or 2 doses (init with 0)
+    result, _ = redistribute_doses_with_state(
+        df,
+        pop,
+        distr_first=distr_first,
+        priority=priority,
+        fractional_dosing=fractional_dosing,
+        fractional_doses=fractional_doses,
+    )
+    return result
+
+
+def redistribute_doses_with_state(
+    df,
+    pop,
+    *,
+    state=None,
+    distr_first=False,
+    priority=None,
+    fractional_dosing=False,
+    fractional_doses=None,
+):
+    """Same as `redistribute_doses`, but can continue from a previous run.
+
+    Args:
+    - state: State returned by a previous call, `df` must only contain the days after `state["date"]`.
+    - other arguments: see `redistribute_doses`.
 
-    # This ordering should optimize lives saved according to relative risk of each age group
-    # releasec by the CDC
-    # https://www.cdc.gov/coronavirus/2019-ncov/images/need-extra-precautions/319360-A_COVID-19_RiskForSevereDisease_Race_Age_2.18_p1.jpg
-    priorities = priority or [
-        (D2, "00-24"),
-        (D2, "25-34"),
-        (D2, "35-44"),
-        (D1, "00-24"),
-        (D2, "55-64"),
-        (D1, "25-34"),
-        (D2, "45-54"),
-        (D1, "35-44"),
-        (D2, "65-74"),
-        (D1, "45-54"),
-        (D2, "75-84"),
-        (D1, "55-64"),
-        (D1, "65-74"),
-        (D2, "85-99"),
-        (D1, "75-84"),
-        (D1, "85-99"),
-    ]
-
-    fractional_doses = {
-        "00-24": 0.25,
-        "25-34": 0.25,
-        "35-44": 0.25,
-        "45-54": 0.25,
-        "55-64": 0.5,
-        "65-74": 0.75,
-        "75-84": 1,
-        "85-99": 1,
+    Returns:
+        (pd.DataFrame, dict): Redistributed doses and the state after the last day of `df`, i.e.
+        the last date, the number of doses given per column (`have_d`) and the remaining
+        priority queue (`priorities`, low to high priority).
+    """
+    fractional_doses = fractional_doses or FRACTIONAL_DOSES
+    columns = list(df.columns)
+    col_idx = {c: i for i, c in enumerate(columns)}
+    have_d = np.zeros(len(columns), dtype=np.int64)  # Have 1 or 2 doses (init with 0)
+    if state:
+        priority = [tuple(c) for c in state["priorities"]]
+        for d, grp, n in state["have_d"]:
+            have_d[col_idx[(d, grp)]] = n
+    order = [col_idx[c] for c in (priority or PRIORITIES)]  # low -> high priority
+    pop_c = np.array([pop[grp] for _, grp in columns])
+    # Share of each assigned dose that overflows to the next group (0 w/o fractional dosing)
+    overflow = np.array(
+        [1 - fractional_doses[grp] if fractional_dosing else 0 for _, grp in columns]
+    )
+    redistribute = np.array([d == D2 or distr_first for d, _ in columns])
+
+    vacc = df.to_numpy().astype(np.int64)
+    result = np.zeros_like(vacc)
+    done = have_d >= pop_c  # groups that don't need any more doses
+    top = len(order) - 1  # index of next group that may need something
+
+    for i in range(len(vacc)):
+        top = _redistribute_day(
+            vacc[i], result[i], have_d, pop_c, done, order, top, overflow, redistribute
+        )
+    if len(df):
+        last = pd.Timestamp(df.index[-1]).isoformat()
+    else:
+        last = state["date"] if state else None
+    state = {
+        "date": last,
+        "have_d": [[d, grp, int(n)] for (d, grp), n in zip(columns, have_d)],
+        "priorities": [list(columns[k]) for k in order[: top + 1] if not done[k]],
     }
+    return pd.DataFrame(result, index=df.index, columns=df.columns), state
+
+
+def _redistribute_day(
+    vacc, result, have_d, pop, done, order, top, overflow, redistribute
+):
+    """Redistribute the doses `vacc` of one day, column by column. Updates `result`, `have_d` and
+    `done` in place and returns the new priority pointer `top`."""
+    for c in range(len(vacc)):
+        v = vacc[c]
+        while top >= 0 and done[order[top]]:
+            top -= 1
+        j = order[top] if redistribute[c] else c
+        while v > 0:
+            # how many stay in group, how many can go to other groups (according to priority)
+            missing = min(v, pop[j] - have_d[j])
+            v -= missing
+            if missing > 0:
+                v += int(missing * overflow[j])
+                have_d[j] += missing
+                result[j] += missing
+                done[j] = have_d[j] >= pop[j]
+            while top >= 0 and done[order[top]]:
+                top -= 1
+            if top < 0:
+                break  # everybody is vaccinated, remaining doses are not needed
+            j = order[top]
+    return top
+
+
+def redistribute_doses_pandas(
+    df,
+    pop,
+    *,
+    distr_first=False,
+    priority=None,
+    fractional_dosing=False,
+    fractional_doses=None,
+) -> pd.DataFrame:
+    """Reference implementation of `redistribute_doses` (one row/dose at a time with pandas).
+    Total number of vaccinations for each day does not change (as it is assumed that this is limited by capacity/supply).
+
+    Args:
+    - df pd.DataFrame: Dataframe with index = Date and columns with number of vaccinations per day and age group.
+        An example column would have the "Name" `(D1, "25-34")`. Age groups from 25-34 to 75-84 and then 85-99.
+        D1 is the string "1D", for second doses D2 == "2D" must be used.
+    - pop: Population of each age group from previous DataFrame.
+    - distr_first: Also distribute first doses. This is likely a bad idea as at least some of the first
+        doses for younger people were given to at-risk groups.
+    - priority: List of columns from `df` in priority order (which group should be vaccinated first).
+        Sort from low priority to high priority
+
+    Returns:
+        pd.DataFrame: Returns a DF with the same dimensions and columns as `df` but with vaccines
+        redistributed for higher life-saving-potential
+    """
+    have_d = df.iloc[0].copy() * 0  # Have 1 or 2 doses (init with 0)
+
+    priorities = list(priority or PRIORITIES)
+    fractional_doses = fractional_doses or FRACTIONAL_DOSES
 
     def get_remainder_d(d, group, vacc):
         # how many stay in group, how many can go to other groups (according to priority)
@@ -105,4 +252,182 @@ def redistribute_doses(
     return pd.DataFrame(rows, index=df.index)
 
 
+def update_redistribution(df, pop, path, **kwargs) -> pd.DataFrame:
+    """Redistribute doses and persist the result to `path` (parquet) and its state (json next to it).
+    If a previous result for the same population and arguments exists, only the days after
+    it are calculated and appended. Days that were already processed are not re-checked.
+
+    Args:
+    - df, pop, kwargs: see `redistribute_doses`.
+    - path: Parquet file of the result.
+
+    Returns:
+        pd.DataFrame: Redistributed doses for all days of `df`.
+    """
+    path = Path(path)
+    state_path = path.with_suffix(".json")
+    settings = {k: kwargs[k] for k in sorted(kwargs)}
+    settings["pop"] = {str(grp): float(n) for grp, n in pop.items()}
+    settings = json.loads(json.dumps(settings))  # tuples -> lists, same as when loaded
+
+    previous, state = None, None
+    if path.exists() and state_path.exists():
+        saved = json.loads(state_path.read_text())
+        if saved["settings"] == settings and saved["state"]["date"]:
+            previous = pd.read_parquet(path)
+            state = saved["state"]
+            # the state is written after the result, i.e. it matches only if both were written
+            if len(previous) == 0 or previous.index[-1] != pd.Timestamp(state["date"]):
+                previous, state = None, None
+            else:
+                df = df[df.index > pd.Timestamp(state["date"])]
+
+    rd, state = redistribute_doses_with_state(df, pop, state=state, **kwargs)
+    if previous is not None:
+        rd = pd.concat([previous, rd])
+    with atomic_write(path) as f:
+        rd.to_parquet(f)
+    with atomic_write(state_path) as f:
+        f.write(json.dumps({"settings": settings, "state": state}).encode())
+    return rd
+
+
+def _next_open(order, top, done):
+    """Move the priority pointers `top` (one per batch element) down to the next group that is not done"""
+    stale = np.flatnonzero(top >= 0)
+    while len(stale):
+        stale = stale[done[stale, order[stale, top[stale]]]]
+        top[stale] -= 1
+        stale = stale[top[stale] >= 0]
+    return top
+
+
+def redistribute_doses_arrays(vacc, pop, order, n_order, overflow, redistribute):
+    """Array core of `redistribute_doses_batch`, all arguments are numpy arrays.
+    B is the batch dimension (e.g. region x scenario), C the (dose, group) columns.
+
+    Each day is allocated for all batch elements at once: doses that aren't redistributed stay
+    in their group (as far as it needs them), everything else goes to the open group with the
+    highest priority. This is exact as long as that group isn't filled up during the day,
+    on the few days it is, the batch element runs the column loop of `redistribute_doses`.
+
+    Args:
+    - vacc: (B, days, C) vaccinations per day
+    - pop: (B, C) population of the group of each column
+    - order: (B, max(n_order)) column indices in priority order (low to high), padded at the end
+    - n_order: (B,) length of each priority order
+    - overflow: (B, C) share of each assigned dose that overflows to the next group
+    - redistribute: (B, C) whether doses from a column are given to the highest priority group
+
+    Returns:
+        np.ndarray: (B, days, C) redistributed vaccinations
+    """
+    vacc = np.asarray(vacc, dtype=np.int64)
+    n_batch, n_days, n_cols = vacc.shape
+    rows = np.arange(n_batch)
+    result = np.zeros((n_batch, n_days, n_cols), dtype=np.int64)
+    have_d = np.zeros((n_batch, n_cols), dtype=np.int64)
+    done = pop <= 0
+    top = _next_open(order, np.asarray(n_order) - 1, done)
+    for i in range(n_days):
+        v = vacc[:, i]
+        kept = np.where(redistribute, 0, np.clip(np.minimum(v, pop - have_d), 0, None))
+        # doses for the top group: redistributed ones, left over ones and the overflow
+        # of fractional doses (every dose it gets overflows again, as long as it isn't full)
+        pool = v - kept + (kept * overflow).astype(np.int64)
+        j = order[rows, np.maximum(top, 0)]
+        to_top = np.zeros(n_batch, dtype=np.int64)
+        b = rows[(top >= 0) & pool.any(axis=-1)]
+        o = overflow[b, j[b]][:, None]
+        while len(b):
+            to_top[b] += pool[b].sum(axis=-1)
+            pool[b] = (pool[b] * o).astype(np.int64)
+            more = pool[b].any(axis=-1)
+            b, o = b[more], o[more]
+        filled = kept[rows, j] + to_top > pop[rows, j] - have_d[rows, j]
+        filled &= top >= 0
+        kept[rows, j] += to_top
+        kept[filled] = 0
+        result[:, i] = kept
+        have_d += kept
+        for b in np.flatnonzero(filled):
+            top[b] = _redistribute_day(
+                vacc[b, i],
+                result[b, i],
+                have_d[b],
+                pop[b],
+                done[b],
+                order[b],
+                top[b],
+                overflow[b],
+                redistribute[b],
+            )
+        done |= have_d >= pop
+        top = _next_open(order, top, done)
+    return result
+
+
+@profile
+def redistribute_doses_batch(df, population, scenarios, regions=None) -> pd.DataFrame:
+    """Run `redistribute_doses` for every region and scenario at once.
+
+    Args:
+    - df pd.DataFrame: Vaccinations as returned by `get_vaccinations_at`, columns are (Region, dose, group).
+    - population pd.DataFrame: Population per age group (index) and region (columns), see `get_demographics_at`.
+    - scenarios: Dict of scenario name -> keyword arguments of `redistribute_doses`
+        (`distr_first`, `priority`, `fractional_dosing`, `fractional_doses`).
+    - regions: Regions to calculate, defaults to all regions in `df`.
+
+    Returns:
+        pd.DataFrame: Redistributed doses with columns (Region, Scenario, dose, group)
+    """
+    regions = regions or list(df.columns.unique(level=0))
+    columns = list(df[regions[0]][[D1, D2]].columns)
+    col_idx = {c: i for i, c in enumerate(columns)}
+    groups = [grp for _, grp in columns]
+
+    vacc = np.stack([df[r][[D1, D2]][columns].to_numpy() for r in regions])
+    pop = np.stack([population[r][groups].to_numpy() for r in regions])
+
+    orders, overflows, redistributes = [], [], []
+    for kwargs in scenarios.values():
+        orders.append([col_idx[c] for c in (kwargs.get("priority") or PRIORITIES)])
+        fd = kwargs.get("fractional_dosing", False)
+        fractions = kwargs.get("fractional_doses") or FRACTIONAL_DOSES
+        overflows.append([1 - fractions[grp] if fd else 0 for grp in groups])
+        first = kwargs.get("distr_first", False)
+        redistributes.append([d == D2 or first for d, _ in columns])
+    n_order = np.array([len(o) for o in orders])
+    order = np.zeros((len(orders), n_order.max()), dtype=np.int64)
+    for k, o in enumerate(orders):
+        order[k, : len(o)] = o
+
+    # batch dimension is region x scenario, region-major
+    n_s = len(scenarios)
+    r_i = np.repeat(np.arange(len(regions)), n_s)
+    s_i = np.tile(np.arange(n_s), len(regions))
+    result = redistribute_doses_arrays(
+        vacc[r_i],
+        pop[r_i],
+        order[s_i],
+        n_order[s_i],
+        np.array(overflows)[s_i],
+        np.array(redistributes)[s_i],
+    )
+
+    labels = [(r, s, d, grp) for r in regions for s in scenarios for d, grp in columns]
+    result = result.transpose(1, 0, 2).reshape(len(df), -1)
+    return pd.DataFrame(
+        result, index=df.index, columns=pd.MultiIndex.from_tuples(labels)
+    )
+
+
+def check_redistribution(df, pop, **kwargs) -> bool:
+    """Compare `redistribute_doses` with the reference implementation `redistribute_doses_pandas`.
+    Takes the same arguments as both and returns True if results are identical."""
+    fast = redistribute_doses(df, pop, **kwargs)
+    reference = redistribute_doses_pandas(df, pop, **kwargs)
+    return bool((fast.to_numpy() == reference.to_numpy()).all())
+
+
 # %%
@@ -0,0 +1,48 @@
+#%%
+import numpy as np
+
+# Default efficacy curves, (days after the first shot, efficacy).
+# In either case, vaccination starts with the 1st dose and divergence happens after ~3 weeks
+DAYS_BETWEEN_SHOTS = 21
+FIRST_DOSE = [
+    (0, 0),
+    (7, 0.005),  # negligible gain in first week after shot
+    (DAYS_BETWEEN_SHOTS, 0.75),
+]
+# TODO: Find data from UK regarding this number
+ONE_DOSE = FIRST_DOSE + [(DAYS_BETWEEN_SHOTS + 10, 0.75)]
+# From biontech study
+TWO_DOSES = FIRST_DOSE + [(DAYS_BETWEEN_SHOTS + 14, 0.90)]
+
+
+class EfficacyCurve:
+    """Vaccine efficacy n days after the first shot.
+    Linear interpolation between `points` (tuples of (day, efficacy)), constant after the last point.
+    The curve is stored as lookup table with one entry per day.
+    """
+
+    def __init__(self, points) -> None:
+        days, efficacy = zip(*sorted(points))
+        self.points = list(zip(days, efficacy))
+        self.table = np.interp(np.arange(days[-1] + 1), days, efficacy)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __call__(self, days):
+        """Efficacy after `days` (int or array of ints)"""
+        return self.table[np.clip(days, 0, len(self.table) - 1)]
+
+    def padded(self, length):
+        """Lookup table extended to `length` days"""
+        return self(np.arange(length))
+
+
+def evaluate_curves(curves, days) -> np.ndarray:
+    """Evaluate several curves at once, returns an array with shape (len(curves), *days.shape)"""
+    length = max(len(c) for c in curves)
+    tables = np.stack([c.padded(length) for c in curves])
+    return tables[:, np.clip(days, 0, length - 1)]
+
+
+# %%
@@ -0,0 +1,216 @@
+#%%
+import numpy as np
+import pandas as pd
+
+from data_loading import D1, D2, age_brackets
+from efficacy import DAYS_BETWEEN_SHOTS, ONE_DOSE, TWO_DOSES, EfficacyCurve
+from profiling import profile
+
+# Efficacy of first and second dose, see dose_redistributing_methods.py
+EFFICACY_D1 = 0.89
+EFFICACY_D2 = 0.95
+
+# Efficacy n days after the first shot, default kernels of `kernel_immunity`
+KERNELS = {D1: EfficacyCurve(ONE_DOSE).table, D2: EfficacyCurve(TWO_DOSES).table}
+
+
+@profile
+def get_avg_immunity(df, pop):
+    df = df.cumsum().copy()
+    df[D1] -= df[D2]  # D1 contains now only 1st dose instead
+    imm_p = df[D1].copy() * 0
+    imm_p += (df[D1] * EFFICACY_D1) / pop
+    imm_p += (df[D2] * EFFICACY_D2) / pop
+    return imm_p
+
+
+@profile
+def calc_weighted_immunity(imm, weights) -> pd.DataFrame:
+    dfs = []
+    for name, weight in weights.items():
+        imm_w = (imm * weight).sum(axis=1) / weight.sum()
+        df = pd.DataFrame({name: imm_w})
+        dfs.append(df)
+    a, *bs = dfs
+    for b in bs:
+        a = a.join(b)
+    return a
+
+
+#%% Same as above on numpy arrays, the last axis are the age groups
+def avg_immunity_arrays(d1, d2, pop):
+    """Array version of `get_avg_immunity`.
+    `d1` and `d2` are daily first/second doses with shape (..., days, groups), `pop` has shape (..., groups).
+    """
+    d1 = d1.cumsum(axis=-2)
+    d2 = d2.cumsum(axis=-2)
+    pop = np.expand_dims(pop, -2)
+    return ((d1 - d2) * EFFICACY_D1 + d2 * EFFICACY_D2) / pop
+
+
+def weighted_immunity_arrays(imm, weights):
+    """Array version of `calc_weighted_immunity` for a single weighting.
+    `imm` has shape (..., days, groups), `weights` (groups,). Returns shape (..., days).
+    """
+    return (imm * weights).sum(axis=-1) / weights.sum()
+
+
+#%% Immunity from an efficacy curve
+@profile
+def kernel_immunity(vacc, kernel):
+    """Immunity from daily vaccinations, calculated as convolution with the efficacy curve.
+
+    Args:
+    - vacc: Vaccinations per day, shape (days, ...), e.g. one column per country.
+    - kernel: Efficacy n days after vaccination for n = 0, 1, ..., stays at the last value afterwards.
+
+    Returns:
+        np.ndarray: Same shape as `vacc`, `result[x] = sum_i vacc[i] * kernel[max(0, x - i)]`
+    """
+    vacc = np.asarray(vacc, dtype=float)
+    kernel = np.asarray(kernel, dtype=float)
+    n = len(vacc)
+    result = np.zeros_like(vacc)
+    # direct convolution for the rising part of the curve (lags 0 .. len(kernel) - 2)
+    for lag, e in enumerate(kernel[:-1]):
+        if lag >= n:
+            break
+        result[lag:] += e * vacc[: n - lag]
+    # everything vaccinated at least len(kernel) - 1 days ago has the final efficacy
+    cum = vacc.cumsum(axis=0)
+    plateau = len(kernel) - 1
+    if plateau < n:
+        result[plateau:] += kernel[-1] * cum[: n - plateau]
+    # vaccinations in the future count with the efficacy of day 0 (usually 0)
+    result += kernel[0] * (cum[-1] - cum)
+    return result
+
+
+#%% Second doses
+@profile
+def first_doses_with_backlog(vacc, intervals=(21,)):
+    """Split daily vaccinations into first doses, assuming everyone gets a second dose after
+    a fixed interval and second doses take precedence over new first doses.
+    Second doses that can't be given on their day are carried over to the next day.
+
+    The backlog is a ring buffer with one slot per day of the interval, all countries and
+    intervals are advanced at once.
+
+    Args:
+    - vacc: Vaccinations per day, shape (days, countries).
+    - intervals: Days between first and second dose, one result per interval.
+
+    Returns:
+        np.ndarray: First doses per day, shape (len(intervals), days, countries)
+    """
+    vacc = np.asarray(vacc, dtype=float)
+    n_days = len(vacc)
+    intervals = np.asarray(intervals)
+    k = np.arange(len(intervals))
+    backlog = np.zeros((len(intervals), intervals.max(), *vacc.shape[1:]))
+    result = np.zeros((len(intervals), *vacc.shape))
+    for i in range(n_days):
+        today, tomorrow = i % intervals, (i + 1) % intervals
+        need_2nd = backlog[k, today]  # people that need their 2nd shot today
+        new_vac = np.maximum(vacc[i] - need_2nd, 0)
+        # those that didn't get their 2nd dose are first in line tomorrow
+        backlog[k, tomorrow] += np.maximum(need_2nd - vacc[i], 0)
+        backlog[k, today] = new_vac  # need their 2nd shot in `interval` days
+        result[:, i] = new_vac
+    return result
+
+
+#%% Age groups
+@profile
+def allocate_by_age(vacc, need):
+    """Give doses to age groups in order, a group only gets doses once all groups before it are done.
+
+    Args:
+    - vacc: Doses per day, shape (days, countries).
+    - need: Remaining need per country and age group at the start, shape (countries, groups),
+        groups sorted by priority (most important first).
+
+    Returns:
+        np.ndarray: Doses per day, country and age group, shape (days, countries, groups).
+        Doses that are left over once every group is done are not assigned.
+    """
+    vacc = np.asarray(vacc, dtype=float)
+    need = np.array(need, dtype=float)
+    result = np.zeros((*vacc.shape, need.shape[-1]))
+    for i in range(len(vacc)):
+        ahead = need.cumsum(axis=-1) - need  # doses needed by more important groups
+        result[i] = np.clip(vacc[i][:, None] - ahead, 0, need)
+        need -= result[i]
+    return result
+
+
+#%% Immunity per country
+def calc_immunity_1d(df, kernel=KERNELS[D1]):
+    """Input is DF with #vacc per mill/day (one column per country)
+    Calculates the added immunity of each row to subsequent rows by convolving
+    the vaccinations with the efficacy curve (all countries at once).
+    At the end, divides per 1e6 to get the immunity per person (I was a bit unsure about this step)
+    """
+    result = kernel_immunity(df.to_numpy(), kernel)
+    result = pd.DataFrame(result, index=df.index, columns=list(df.columns))
+    result /= 1e6
+    return result
+
+
+def calc_immunity_2d(df, kernel=KERNELS[D2], days_between_shots=DAYS_BETWEEN_SHOTS):
+    """Does the same as `calc_immunity_1d` for two doses.
+    This is achieved by having a backlog for each country.
+    - If someone is vaccinated, they are added to the backlog
+    - After N days (whatever the time  between vaccs) the people from backlog are prioritised
+        - on day X there are 100 vaccs, 5 people on backlog: 5 snd doses, 95 new doses, put 95 on backlog on day X+N
+        - on day Y 100 vaccs, 105 on backlog: no new doses, but 5 remain, put 5 on backlog of Y+1
+    """
+    # Backlog of all countries is simulated at once (see `first_doses_with_backlog`)
+    new_vacs = first_doses_with_backlog(df.to_numpy(), [days_between_shots])[0]
+    result = kernel_immunity(new_vacs, kernel)
+    result = pd.DataFrame(result, index=df.index, columns=list(df.columns))
+    result /= 1e6
+    return result
+
+
+def calc_immunity_age(
+    vacc, age, kernel, backlog=False, days_between_shots=DAYS_BETWEEN_SHOTS
+):
+    """Immunity per country and age group, older groups get vaccinated first.
+
+    Args:
+    - vacc: Vaccinations per day (one column per country).
+    - age: Population per country (index) and age group (columns).
+    - kernel: Efficacy curve, see `kernel_immunity`.
+    - backlog: Use part of the vaccinations for second doses (see `calc_immunity_2d`)
+
+    Returns:
+        pd.DataFrame: Immunity [0,1] with columns (country, age group) and (country, "Total")
+    """
+    # Make 2 tier index & change order of age-brackets
+    cols = [c for c in vacc.columns if c in age.index]  # countries in both datasets
+    age_groups = list(reversed(age.columns))  # age brackets
+    age = age.loc[cols, age_groups]  # most important groups first
+    need_1 = age.copy()  # needs 1 dose
+    young = [grp for grp, (_, upper) in age_brackets(age_groups).items() if upper < 15]
+    need_1[young] = 0  # young people don't get vaccine, tough luck!
+
+    first = vacc[cols].to_numpy()
+    if backlog:
+        first = first_doses_with_backlog(first, [days_between_shots])[0]
+    get_one = allocate_by_age(first, need_1.to_numpy())  # days x countries x groups
+    # this must be normalized by size of group in question
+    pop = age.to_numpy()
+    p = np.divide(get_one, pop, out=np.zeros_like(get_one), where=pop > 0)
+    imm = kernel_immunity(p.reshape(len(vacc), -1), kernel).reshape(p.shape)
+
+    columns = pd.MultiIndex.from_product([cols, age_groups])
+    result = pd.DataFrame(imm.reshape(len(vacc), -1), index=vacc.index, columns=columns)
+    # calculate weighted mean immunisation for whole countries
+    total = (imm * pop).sum(axis=-1) / pop.sum(axis=-1)
+    columns = pd.MultiIndex.from_product([cols, ["Total"]])
+    total = pd.DataFrame(total, index=vacc.index, columns=columns)
+    return pd.concat([result, total], axis=1)
+
+
+# %%
@@ -1,24 +1,25 @@
 #%%
-import itertools
-from collections import defaultdict, deque
 from pathlib import Path
 
 import matplotlib.pyplot as plt
-import numpy as np
 import pandas as pd
 import seaborn as sns
 
 sns.set_theme()
 
 from data_loading import *
+from efficacy import DAYS_BETWEEN_SHOTS, ONE_DOSE, TWO_DOSES, EfficacyCurve
+from immunity import calc_immunity_1d, calc_immunity_2d, calc_immunity_age
 from utility import (
     write_img_to_file,
     write_to_file,
     write_img_to_file,
     OUT_FOLDER,
+    ReportDocument,
 )
 
-ANALYSIS_NOTES = OUT_FOLDER / "analysis.md"
+# Sections are updated in memory, written with ANALYSIS_NOTES.flush()
+ANALYSIS_NOTES = ReportDocument(OUT_FOLDER / "analysis.md")
 
 
 current_dosing = {
@@ -44,34 +45,23 @@ deaths_by_age = get_death_distr_by_age_us()
 
 
 # %% Data for Immunity stemming from Vaccination:
-# TODO: This should be made somehow less shitty s.t it is easy to plop in a replacement
-# immunity-curve to see results
+# A replacement immunity-curve can be passed as list of (day, efficacy) points
 
 
 class VaccineEfficacy:
-    def __init__(self) -> None:
-        self.days_between_shots = 21
-        base_immunity = 0
-        first_dose = [
-            (0, base_immunity),
-            (7, base_immunity + 0.005),  # negligible gain in first week after shot
-            (self.days_between_shots, 0.75),
-        ]
-
-        # In either case, vacc starts with 1st dose and divergence happens after ~3 weeks
-
-        # TODO: Find data from UK regarding this number
-        one_dose = first_dose + [(self.days_between_shots + 10, 0.75)]
-        # From biontech study
-        two_dose = first_dose + [(self.days_between_shots + 14, 0.90)]
-
-        max_days = max([d for d, _ in one_dose] + [d for d, _ in two_dose])
-        days = pd.DataFrame({"days": range(max_days + 1)}).set_index("days")
-        eff_1d = pd.DataFrame(one_dose, columns=["days", D1]).set_index("days")
-        eff_2d = pd.DataFrame(two_dose, columns=["days", D2]).set_index("days")
-        # create df from interpolation of data points
-        tmp = days.join(eff_1d).join(eff_2d)
-        self.efficacy = tmp.sort_index().interpolate(axis=0)
+    def __init__(self, one_dose=None, two_dose=None) -> None:
+        self.days_between_shots = DAYS_BETWEEN_SHOTS
+        # defaults, see efficacy.py
+        one_dose = one_dose or ONE_DOSE
+        two_dose = two_dose or TWO_DOSES
+
+        # create lookup tables from interpolation of data points
+        self.curves = {D1: EfficacyCurve(one_dose), D2: EfficacyCurve(two_dose)}
+        max_days = max(len(c) for c in self.curves.values())
+        days = pd.Index(range(max_days), name="days")
+        self.efficacy = pd.DataFrame(
+            {d: c.padded(max_days) for d, c in self.curves.items()}, index=days
+        )
 
     def print_table(self):
         tmp = (self.efficacy.iloc[:50:3] * 100).astype(int)
@@ -83,93 +73,26 @@ class VaccineEfficacy:
         caption = "Estimated efficacy after n days"
         write_img_to_file(ANALYSIS_NOTES, "EfficacyFigure", imgPath, caption)
 
-    def __get_eff(self, doses, days):
-        d = [D0, D1, D2][doses]
-        x = self.efficacy[d]
-        if days > len(self.efficacy) - 1:
-            return x.iloc[-1]
-        else:
-            return x[days]
-
     def one_dose(self, x):
-        return self.__get_eff(1, x)
+        return self.curves[D1](x)
 
     def two_dose(self, x):
-        return self.__get_eff(2, x)
+        return self.curves[D2](x)
 
 
 VACC = VaccineEfficacy()
 VACC.print_table()
 
-# %% Calculate immunity from two regimes
-def calc_immunity_1d(df):
-    """Input is DF with #vacc per mill/day (one column per country)
-    Iterates over all rows, calculates the added immunity of each row to
-    subsequent rows.
-    At the end, divides per 1e6 to get the immunity per person (I was a bit unsure about this step)
-    """
-    df_columns = list(df.columns)
-    result = pd.DataFrame(0, index=df.index, columns=df_columns)
-    num_days = len(df)
-    days = np.arange(result.shape[0])
-    cols = list(df.columns)
-    for (_, row), i in zip(df.iterrows(), days):
-        days_since = [max(0, x - i) for x in range(num_days)]
-        for country in cols:
-            new_vac = row[country]
-            result[country] += [e * new_vac for e in map(VACC.one_dose, days_since)]
-    result /= 1e6
-    return result
-
-
-#%%
-
-
-def calc_immunity_2d(df):
-    """Does the same as `calc_immunity_1d` for two doses.
-    This is achieved by having a backlog for each country.
-    - If someone is vaccinated, they are added to a deque
-    - After N days (whatever the time  between vaccs) the people from backlog are prioritised
-        - on day X there are 100 vaccs, 5 people on backlog: 5 snd doses, 95 new doses, put 95 on backlog on day X+N
-        - on day Y 100 vaccs, 105 on backlog: no new doses, but 5 remain, put 5 on backlog of Y+1
-    """
-    # Init backlog with all zeros
-    BACKLOG = defaultdict(lambda: deque([0] * VACC.days_between_shots))
-    df_columns = list(df.columns)
-    result = pd.DataFrame(0, index=df.index, columns=df_columns)
-    num_days = len(df)
-    days = np.arange(result.shape[0])
-    cols = list(df.columns)
-    for (_, row), i in zip(df.iterrows(), days):
-        days_since = [max(0, x - i) for x in range(num_days)]
-        for country in cols:
-            backlog = BACKLOG[country]  # get backlog of country
-            need_2nd = backlog.popleft()  # remove first
-            total_vacs_of_day = row[country]
-            if need_2nd > total_vacs_of_day:
-                new_vac_on_day = 0
-                # give vacc to those that need 2nd shot
-                # and add remaining to backlog for next day
-                didnt_get_second = need_2nd - total_vacs_of_day
-                backlog[0] += didnt_get_second
-            else:
-                new_vac_on_day = total_vacs_of_day - need_2nd
-            backlog.append(new_vac_on_day)  # add new one
-            result[country] += [
-                e * new_vac_on_day for e in map(VACC.two_dose, days_since)
-            ]
-            # TOTAL_VAC[(country, D2)].append(new_vac_on_day)
-            # TOTAL_JAB[(country, D2)].append(total_vacs_of_day)
-    result /= 1e6
-    return result
-
-
-dvs = get_vaccination_data(extend_by_days=15)[countries]
-dds = get_death_data(extend_by_days=15)[countries][dvs.index.min() :]
+# %% Calculate immunity from two regimes, see `calc_immunity_1d` and `calc_immunity_2d`
+dvs = get_vaccination_data(extend_by_days=15, locations=countries)[countries]
+dds = get_death_data(extend_by_days=15, locations=countries, since=dvs.index.min())
+dds = dds[countries][dvs.index.min() :]
 dds = dds.ffill()
 
-imm1 = calc_immunity_1d(dvs)
-imm2 = calc_immunity_2d(dvs)
+imm1 = calc_immunity_1d(dvs, VACC.efficacy[D1].to_numpy())
+imm2 = calc_immunity_2d(
+    dvs, VACC.efficacy[D2].to_numpy(), days_between_shots=VACC.days_between_shots
+)
 
 #%%
 
@@ -229,131 +152,32 @@ for (x, y) in [(D2, D0), (D1, D0), (D1, D2)]:
     )
 
 write_to_file(ANALYSIS_NOTES, "SimpleAnalysis", current_total_deaths.to_markdown())
+ANALYSIS_NOTES.flush()
 
-# %%
+# %% Immunity per age group, see `calc_immunity_age`
 def calc_immunity_1d_age():
     # Load data
     vacc = get_vaccination_data(per_million=False).astype(int)
     age = get_age_data()  #
-
-    # Make 2 tier index & change order of age-brackets
-    cols = set(vacc.columns) & set(age.index)  # countries available in both datasets
-    age_groups = list(reversed(age.columns))  # age brackets
-    age = age[age_groups]  # most important groups first
-    new_cols = list(itertools.product(cols, age_groups))
-    result = pd.DataFrame(0, index=vacc.index, columns=new_cols)  # immunity [0,1]
-    need_1 = age.copy()  # needs 1 dose
-    need_1[["0-4", "5-14"]] = 0  # young people don't get vaccine, tough luck!
-    result.columns = pd.MultiIndex.from_tuples(result.columns)
-    #
-    num_days = len(vacc)
-    days = np.arange(result.shape[0])
-    for (day, row), i in zip(vacc.iterrows(), days):
-        days_since = [max(0, x - i) for x in range(num_days)]
-        for country in cols:
-            new_vac = row[country]
-            if country not in need_1.index:
-                print(country)
-                continue
-            n1 = need_1.loc[country]
-            get_one = []
-            for grp in age_groups:
-                need = n1[grp]
-                if need == 0:
-                    continue
-                # print(f"{grp}: {need} {new_vac}")
-                if need > new_vac:
-                    get_one.append((grp, new_vac))
-                    need_1.loc[country][grp] -= new_vac
-                    new_vac = 0
-                    break  # most important group not finished, break here
-                elif need > 0:
-                    get_one.append((grp, need))
-                    need_1.loc[country][grp] = 0
-                    new_vac -= need
-            if new_vac:
-                print(country, new_vac)
-            for grp, n in get_one:
-                # n = number of vacc
-                # this must be normalized by size of group in question
-                p = n / age.loc[country][grp]
-                result[country, grp] += [e * p for e in map(VACC.one_dose, days_since)]
-    for c in cols:
-        # calculate weighted mean immunisation for whole countries
-        population = age.loc[c]
-        element_wise_mult = (result[c] * population[age_groups]).sum(axis=1)
-        result[c, "Total"] = element_wise_mult / age.loc[c].sum()
-    return result
+    return calc_immunity_age(
+        vacc,
+        age,
+        VACC.efficacy[D1].to_numpy(),
+        days_between_shots=VACC.days_between_shots,
+    )
 
 
 def calc_immunity_2d_age():
     # Load data
     vacc = get_vaccination_data(per_million=False).astype(int)
     age = get_age_data()  #
-
-    # Make 2 tier index & change order of age-brackets
-    cols = set(vacc.columns) & set(age.index)  # countries available in both datasets
-    age_groups = list(reversed(age.columns))  # age brackets
-    age = age[age_groups]  # most important groups first
-    new_cols = list(itertools.product(cols, age_groups))
-    result = pd.DataFrame(0, index=vacc.index, columns=new_cols)  # immunity [0,1]
-    need_1 = age.copy()  # needs 1 dose
-    need_1[["0-4", "5-14"]] = 0  # young people don't get vaccine, tough luck!
-    result.columns = pd.MultiIndex.from_tuples(result.columns)
-    #
-    num_days = len(vacc)
-    days = np.arange(result.shape[0])
-    BACKLOG = defaultdict(lambda: deque([0] * VACC.days_between_shots))
-    for (day, row), i in zip(vacc.iterrows(), days):
-        days_since = [max(0, x - i) for x in range(num_days)]
-        for country in cols:
-            # Add backlog mechanism from calc_immunity_2d above
-            backlog = BACKLOG[country]  # get backlog of country
-            need_2nd = backlog.popleft()  # remove first
-            total_vacs_of_day = row[country]
-            if need_2nd > total_vacs_of_day:
-                new_vac_on_day = 0
-                # give vacc to those that need 2nd shot
-                # and add remaining to backlog for next day
-                didnt_get_second = need_2nd - total_vacs_of_day
-                backlog[0] += didnt_get_second
-            else:
-                new_vac_on_day = total_vacs_of_day - need_2nd
-            backlog.append(new_vac_on_day)  # add new one
-
-            new_vac = new_vac_on_day
-            if country not in need_1.index:
-                print(country)
-                continue
-            n1 = need_1.loc[country]
-            get_one = []
-            for grp in age_groups:
-                need = n1[grp]
-                if need == 0:
-                    continue
-                # print(f"{grp}: {need} {new_vac}")
-                if need > new_vac:
-                    get_one.append((grp, new_vac))
-                    need_1.loc[country][grp] -= new_vac
-                    new_vac = 0
-                    break  # most important group not finished, break here
-                elif need > 0:
-                    get_one.append((grp, need))
-                    need_1.loc[country][grp] = 0
-                    new_vac -= need
-            if new_vac:
-                print(country, new_vac)
-            for grp, n in get_one:
-                # n = number of vacc
-                # this must be normalized by size of group in question
-                p = n / age.loc[country][grp]
-                result[country, grp] += [e * p for e in map(VACC.two_dose, days_since)]
-    for c in cols:
-        # calculate weighted mean immunisation for whole countries
-        population = age.loc[c]
-        element_wise_mult = (result[c] * population[age_groups]).sum(axis=1)
-        result[c, "Total"] = element_wise_mult / age.loc[c].sum()
-    return result
+    return calc_immunity_age(
+        vacc,
+        age,
+        VACC.efficacy[D2].to_numpy(),
+        backlog=True,
+        days_between_shots=VACC.days_between_shots,
+    )
 
 
 if True:
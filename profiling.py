@@ -0,0 +1,219 @@
+# %%
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Set to a file name to profile a run and write the trace there, e.g. FDF_PROFILE=trace.json
+PROFILE_ENV = "FDF_PROFILE"
+
+
+class Stage:
+    """A running stage, see `Profiler.stage`. Use `output` to record the size of its result."""
+
+    def __init__(self, name, meta) -> None:
+        self.name = name
+        self.meta = meta
+        self.peak = 0  # highest peak of the stages inside this one
+
+    def output(self, result):
+        """Record rows and columns of `result` (DataFrame, Series or array), returns `result`"""
+        shape = getattr(result, "shape", None)
+        if shape is not None:
+            self.meta["rows"] = int(shape[0]) if len(shape) > 0 else 1
+            self.meta["columns"] = int(np.prod(shape[1:], dtype=int))
+        return result
+
+
+class _NoStage:
+    # stand-in while profiling is off
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def output(self, result):
+        return result
+
+
+_NO_STAGE = _NoStage()
+
+
+class Profiler:
+    """Wall time, CPU time, peak memory and result size of the stages of a run.
+
+    Stages are marked with `stage` (context manager) or `profile` (decorator), both do nothing
+    while the profiler is disabled. Stages can be nested, memory is only traced if enabled with
+    `memory=True` (tracing slows down allocations). Records can be written as a trace in the
+    Chrome trace event format (open it in chrome://tracing or https://ui.perfetto.dev).
+    """
+
+    def __init__(self, enabled=False, memory=True) -> None:
+        self.enabled = False
+        self.memory = memory
+        self.records = []
+        self._stack = threading.local()
+        if enabled:
+            self.enable(memory)
+
+    def enable(self, memory=True):
+        self.enabled = True
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def stage(self, name, **meta):
+        """Context manager that records the stage `name`, `meta` is stored with it"""
+        if not self.enabled:
+            return _NO_STAGE
+        return self._record(name, meta)
+
+    def _running(self) -> list:
+        if not hasattr(self._stack, "stages"):
+            self._stack.stages = []
+        return self._stack.stages
+
+    def _record(self, name, meta):
+        return _Recording(self, name, meta)
+
+    def profile(self, fn=None, *, name=None):
+        """Decorator, records every call of `fn` as a stage named after the function"""
+        if fn is None:
+            return functools.partial(self.profile, name=name)
+        name = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return fn(*args, **kwargs)
+            with self._record(name, dict()) as stage:
+                return stage.output(fn(*args, **kwargs))
+
+        return wrapper
+
+    def take(self) -> list:
+        """Return and remove the records, e.g. to pass them on from a worker process"""
+        records, self.records = self.records, []
+        return records
+
+    def summary(self) -> pd.DataFrame:
+        """Calls, total wall/CPU seconds, highest peak memory and largest result per stage"""
+        df = pd.DataFrame(self.records)
+        if df.empty:
+            return df
+        for column in ["peak_bytes", "rows", "columns"]:
+            if column not in df:
+                df[column] = np.nan
+        summary = df.groupby("name").agg(
+            calls=("wall", "size"),
+            wall=("wall", "sum"),
+            cpu=("cpu", "sum"),
+            peak_mb=("peak_bytes", "max"),
+            rows=("rows", "max"),
+            columns=("columns", "max"),
+        )
+        summary["peak_mb"] /= 2**20
+        return summary.sort_values("wall", ascending=False)
+
+    def print_summary(self, slowest=15):
+        summary = self.summary()
+        if summary.empty:
+            print("No stages recorded")
+            return
+        print(summary.head(slowest).to_string(float_format="{:.3f}".format))
+
+    def write_trace(self, path):
+        """Write the records as Chrome trace events (times in microseconds)"""
+        events = []
+        for r in self.records:
+            args = {
+                k: v
+                for k, v in r.items()
+                if k not in ["name", "start", "wall", "pid", "tid"]
+            }
+            events.append(
+                dict(
+                    name=r["name"],
+                    ph="X",
+                    ts=r["start"] * 1e6,
+                    dur=r["wall"] * 1e6,
+                    pid=r["pid"],
+                    tid=r["tid"],
+                    args=args,
+                )
+            )
+        Path(path).write_text(json.dumps(dict(traceEvents=events), default=str))
+
+
+class _Recording:
+    # context manager of a stage while profiling is on
+    def __init__(self, profiler, name, meta) -> None:
+        self.profiler = profiler
+        self.stage = Stage(name, meta)
+        self.memory = None
+
+    def __enter__(self):
+        stages = self.profiler._running()
+        if self.profiler.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if stages:  # the peak is reset for this stage, keep the one of the parent
+                stages[-1].peak = max(stages[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.memory = current
+        stages.append(self.stage)
+        self.start = time.time()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self.stage
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        stages = self.profiler._running()
+        stages.pop()
+        record = dict(
+            name=self.stage.name,
+            start=self.start,
+            wall=wall,
+            cpu=cpu,
+            depth=len(stages),
+            pid=os.getpid(),
+            tid=threading.get_ident(),
+            **self.stage.meta,
+        )
+        if self.memory is not None and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], self.stage.peak)
+            record["peak_bytes"] = peak - self.memory
+            if stages:
+                stages[-1].peak = max(stages[-1].peak, peak)
+        self.profiler.records.append(record)
+        return False
+
+
+PROFILER = Profiler(enabled=bool(os.environ.get(PROFILE_ENV)))
+stage = PROFILER.stage
+profile = PROFILER.profile
+
+
+def finish():
+    """Write the trace to the file in FDF_PROFILE and print the summary, if profiling is on"""
+    if PROFILER.enabled:
+        path = os.environ.get(PROFILE_ENV) or "trace.json"
+        PROFILER.write_trace(path)
+        PROFILER.print_summary()
+        print(f"Trace written to {path}")
+
+
+# %%
@@ -0,0 +1,96 @@
+# %%
+import functools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from profiling import PROFILER
+
+
+class RenderQueue:
+    """Chart jobs that are collected first and then run on a pool of processes.
+
+    A job is a function and its arguments, both have to be picklable (i.e. the function is
+    defined at module level). Jobs write their output files themselves, return values are ignored.
+    With a `build` (see `build.TaskGraph`) jobs that are up to date are skipped, `outputs(fn, args)`
+    returns the files a job writes, jobs are run again if one of them is missing.
+    If profiling is on (see `profiling.PROFILER`), jobs are recorded in the processes they run in.
+    """
+
+    def __init__(self, build=None, outputs=None) -> None:
+        self.jobs = []
+        self.build = build
+        self.outputs = outputs
+
+    def add(self, fn, *args, label=None, **kwargs):
+        """Add job `fn(*args, **kwargs)`, `label` identifies it in the timings"""
+        if label is None:
+            names = [a for a in args if isinstance(a, str)]
+            label = f"{fn.__name__}({', '.join(names)})"
+        outputs = self.outputs(fn, args) if self.outputs else ()
+        if self.build is None or self.build.outdated(
+            label, fn, args, kwargs, outputs=outputs
+        ):
+            self.jobs.append((label, fn, args, kwargs))
+
+    def run(self, workers=None) -> pd.DataFrame:
+        """Run (and remove) all jobs, `workers=1` runs them in this process.
+
+        Returns:
+            pd.DataFrame: Seconds each job took and the id of the process it ran in, by label
+        """
+        jobs, self.jobs = self.jobs, []
+        profiled = [PROFILER.enabled] * len(jobs)
+        if workers == 1 or not jobs:
+            results = [_run(*job, p) for job, p in zip(jobs, profiled)]
+        else:
+            with ProcessPoolExecutor(workers or os.cpu_count()) as ex:
+                results = list(ex.map(_run, *zip(*jobs), profiled))
+        if self.build is not None:
+            self.build.done(*[label for label, *_ in jobs])
+        for *_, records in results:  # from the workers, own records are already there
+            PROFILER.records += [r for r in records if r["pid"] != os.getpid()]
+        timings = pd.DataFrame(
+            [r[:3] for r in results], columns=["job", "seconds", "pid"]
+        )
+        return timings.astype({"seconds": float, "pid": int}).set_index("job")
+
+
+def _run(label, fn, args, kwargs, profiled=False):
+    if profiled and not PROFILER.enabled:  # worker started without FDF_PROFILE
+        PROFILER.enable()
+    before = len(PROFILER.records)  # forked workers inherit the records of the parent
+    start = time.perf_counter()
+    with PROFILER.stage(fn.__name__, label=label):
+        fn(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    return label, seconds, os.getpid(), PROFILER.records[before:]
+
+
+# Figures are not registered with pyplot, so nothing keeps them alive once a plot is saved
+@functools.cache
+def _figure():
+    from matplotlib.figure import Figure
+
+    return Figure()
+
+
+def figure():
+    """Empty matplotlib figure, each process clears and reuses the same one for every plot"""
+    fig = _figure()
+    fig.clear()
+    return fig
+
+
+def print_timings(timings: pd.DataFrame, slowest=5):
+    """Summary of the result of `RenderQueue.run`"""
+    print(
+        f"{len(timings)} jobs in {timings['pid'].nunique()} processes, "
+        f"{timings['seconds'].sum():.1f}s in total"
+    )
+    print(timings.nlargest(slowest, "seconds").to_string())
+
+
+# %%
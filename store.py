@@ -0,0 +1,146 @@
+# %%
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from data_loading import (
+    get_age_data,
+    get_death_data_by_age,
+    get_deaths_by_age_at,
+    get_demographics_at,
+    get_vaccination_data,
+    get_vaccinations_at,
+)
+from utility import atomic_write
+
+# Processed data as .npy files (opened memory-mapped) plus a JSON index of the axis labels.
+# Dates are the first axis, s.t. arrays are DataFrames indexed by date without copying.
+# Run this file to (re-)export everything.
+STORE_FOLDER = Path("./store")
+
+
+# %% Arrays with labeled axes
+def save_array(name, array, labels, folder=STORE_FOLDER):
+    """Write `array` to `<name>.npy` and the labels of its axes to `<name>.json`.
+    `labels` is a dict of axis name -> labels along that axis, in axis order."""
+    array = np.ascontiguousarray(array)
+    if [len(v) for v in labels.values()] != list(array.shape):
+        raise ValueError(f"labels don't match shape {array.shape} of {name}")
+    index = {axis: [str(x) for x in v] for axis, v in labels.items()}
+    folder = Path(folder)
+    with atomic_write(folder / f"{name}.npy") as f:
+        np.save(f, array)
+    with atomic_write(folder / f"{name}.json") as f:
+        f.write(json.dumps(index, ensure_ascii=False).encode())
+
+
+def load_array(name, folder=STORE_FOLDER, mmap_mode="r"):
+    """Open an array written by `save_array`, returns (array, labels).
+    By default the array is a read-only memory map, i.e. nothing is read until it's used and
+    processes opening the same file share the memory."""
+    folder = Path(folder)
+    labels = json.loads((folder / f"{name}.json").read_text(encoding="utf-8"))
+    return np.load(folder / f"{name}.npy", mmap_mode=mmap_mode), labels
+
+
+def frame_to_array(df: pd.DataFrame, axes):
+    """Reshape a DataFrame indexed by date into an array.
+    The dates become the first axis, the column levels the others. The dtype is kept
+    unless combinations of the column levels are missing, those are NaN.
+
+    Args:
+    - df: DataFrame with dates as index and one or more column levels.
+    - axes: Names of the axes, e.g. ("Date", "Region", "dose", "group").
+
+    Returns:
+        (np.ndarray, dict): Array and its labels, see `save_array`
+    """
+    columns = df.columns
+    if not isinstance(columns, pd.MultiIndex):
+        columns = pd.MultiIndex.from_arrays([columns])
+    levels = [list(columns.unique(level=i)) for i in range(columns.nlevels)]
+    full = pd.MultiIndex.from_product(levels)
+    df = df.set_axis(columns, axis=1)
+    if not columns.equals(full):
+        df = df.reindex(columns=full)
+    array = df.to_numpy().reshape(len(df), *map(len, levels))
+    dates = [str(d.date()) for d in df.index]
+    return array, dict(zip(axes, [dates, *levels]))
+
+
+def array_to_frame(array, labels) -> pd.DataFrame:
+    """Inverse of `frame_to_array`, without copying `array` (e.g. a memory map of `load_array`)"""
+    axes, values = list(labels), list(labels.values())
+    index = pd.DatetimeIndex(values[0], name=axes[0])
+    columns = pd.MultiIndex.from_product(values[1:])
+    array = np.asarray(array).reshape(len(index), -1)
+    return pd.DataFrame(array, index=index, columns=columns, copy=False)
+
+
+# %% Export
+def export_at(folder=STORE_FOLDER):
+    """Austrian data:
+    - at_vaccinations: Date x Region x dose x group
+    - at_population: Region x group
+    - at_death_share: group, share of deaths of each age group"""
+    vacc = get_vaccinations_at().drop(columns="Meta", level=1)
+    array, labels = frame_to_array(vacc, ("Date", "Region", "dose", "group"))
+    save_array("at_vaccinations", array, labels, folder)
+    groups = labels["group"]
+
+    population = get_demographics_at().loc[groups].T
+    save_array(
+        "at_population",
+        population.to_numpy(),
+        {"Region": population.index, "group": groups},
+        folder,
+    )
+
+    deaths = get_deaths_by_age_at().loc["Deaths"].reindex(groups).fillna(0)
+    save_array(
+        "at_death_share",
+        (deaths / deaths.sum()).to_numpy(),
+        {"group": groups},
+        folder,
+    )
+
+
+def export_owid(folder=STORE_FOLDER):
+    """OWID data:
+    - owid_vaccinations: Date x location, daily vaccinations
+    - owid_population: location x group
+    - owid_deaths_by_age: Date x location x group, see `get_death_data_by_age`"""
+    vacc = get_vaccination_data(per_million=False)
+    save_array("owid_vaccinations", *frame_to_array(vacc, ("Date", "location")), folder)
+
+    age = get_age_data()
+    save_array(
+        "owid_population",
+        age.to_numpy(),
+        {"location": age.index, "group": age.columns},
+        folder,
+    )
+
+    deaths = get_death_data_by_age()
+    array, labels = frame_to_array(deaths, ("Date", "location", "group"))
+    save_array("owid_deaths_by_age", array, labels, folder)
+
+
+# %% Load
+def load_vaccinations_at(folder=STORE_FOLDER) -> pd.DataFrame:
+    """Vaccinations (without meta data) as returned by `get_vaccinations_at`, from the store"""
+    return array_to_frame(*load_array("at_vaccinations", folder))
+
+
+def load_population_at(folder=STORE_FOLDER) -> pd.DataFrame:
+    """Population per age group (index) and region (columns), see `get_demographics_at`"""
+    array, labels = load_array("at_population", folder)
+    return pd.DataFrame(array.T, index=labels["group"], columns=labels["Region"])
+
+
+# %%
+if __name__ == "__main__":
+    export_at()
+    export_owid()
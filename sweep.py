@@ -0,0 +1,215 @@
+# %%
+import heapq
+import itertools
+import os
+import random
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from data_loading import D1, D2
+from dose_redistributing_methods import (
+    FRACTIONAL_DOSES,
+    PRIORITIES,
+    redistribute_doses_arrays,
+)
+from immunity import avg_immunity_arrays, weighted_immunity_arrays
+from store import STORE_FOLDER, load_array
+
+# Dose fractions used for the grid of fractional dose tables
+FRACTION_LEVELS = (0.25, 0.5, 0.75, 1)
+
+
+# %% Generate configurations
+def random_priorities(n, seed=0, base=PRIORITIES):
+    """Sample `n` random permutations of the priority list `base`"""
+    rng = random.Random(seed)
+    for _ in range(n):
+        priority = list(base)
+        rng.shuffle(priority)
+        yield priority
+
+
+def fractional_dose_grid(groups=tuple(FRACTIONAL_DOSES), levels=FRACTION_LEVELS):
+    """All fractional dose tables where older groups never get a smaller dose than younger ones"""
+    for fractions in itertools.combinations_with_replacement(levels, len(groups)):
+        yield dict(zip(groups, fractions))
+
+
+def sweep_configs(priorities, fractional_doses=(None,)):
+    """All combinations of priority orders and fractional dose tables.
+    A fractional dose table of `None` means no fractional dosing."""
+    return itertools.product(priorities, fractional_doses)
+
+
+# %% Input arrays are shared with the workers instead of being pickled for each task,
+# either copied to shared memory or as memory maps of the store
+_SHARED = dict()
+
+
+def _share(arrays):
+    blocks, specs = [], dict()
+    for name, arr in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[:] = arr
+        blocks.append(shm)
+        specs[name] = (shm.name, arr.shape, arr.dtype.str)
+    return blocks, specs
+
+
+def _stored(name, folder, index):
+    # days x columns of an array of the store, a view of the memory map if possible
+    array, _ = load_array(name, folder)
+    values = array[index]
+    return values.reshape(len(values), -1)
+
+
+def _attach(specs, stored):
+    # worker initializer, runs once per process
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _SHARED[name] = np.ndarray(shape, dtype, buffer=shm.buf)
+        _SHARED[f"{name}_shm"] = shm  # keep mapping alive
+    for name, args in stored.items():
+        _SHARED[name] = _stored(*args)
+
+
+def _score_chunk(configs, columns, weight_names, rank_by, distr_first, top_k):
+    vacc, pop = _SHARED["vacc"], _SHARED["pop"]
+    col_idx = {c: i for i, c in enumerate(columns)}
+    groups = [grp for d, grp in columns if d == D1]
+    d1 = [col_idx[(D1, grp)] for grp in groups]
+    d2 = [col_idx[(D2, grp)] for grp in groups]
+
+    n = len(configs)
+    n_order = np.array([len(priority) for priority, _ in configs])
+    order = np.zeros((n, n_order.max()), dtype=np.int64)
+    overflow = np.zeros((n, len(columns)))
+    for k, (priority, fractions) in enumerate(configs):
+        order[k, : len(priority)] = [col_idx[c] for c in priority]
+        if fractions is not None:
+            overflow[k] = [1 - fractions[grp] for _, grp in columns]
+    redistribute = np.array([d == D2 or distr_first for d, _ in columns])
+
+    result = redistribute_doses_arrays(
+        np.broadcast_to(vacc, (n, *vacc.shape)),
+        np.broadcast_to(pop, (n, len(columns))),
+        order,
+        n_order,
+        overflow,
+        np.broadcast_to(redistribute, (n, len(columns))),
+    )
+    imm = avg_immunity_arrays(result[..., d1], result[..., d2], pop[d1])
+    # Score = weighted immunity averaged over all days
+    scores = {
+        name: weighted_immunity_arrays(imm, _SHARED[f"w_{i}"]).mean(axis=-1)
+        for i, name in enumerate(weight_names)
+    }
+    best = np.argsort(-scores[rank_by])[:top_k]
+    return [
+        (
+            float(scores[rank_by][k]),
+            {n: float(s[k]) for n, s in scores.items()},
+            configs[k],
+        )
+        for k in best
+    ]
+
+
+# %% Run sweep
+def sweep(df, pop, weights, configs, **kwargs):
+    """Redistribute doses for many configurations in parallel and keep the best ones.
+
+    Args:
+    - df pd.DataFrame: Vaccinations of a single region, columns are (dose, group) (see `redistribute_doses`).
+    - pop: Population of each age group.
+    - weights: Dict of name -> weight per age group, as in `calc_weighted_immunity`.
+    - configs: Iterable of (priority, fractional_doses), see `sweep_configs`.
+    - distr_first: Also distribute first doses.
+    - rank_by: Name of the weighting used for ranking, defaults to the first one.
+    - top_k: Number of configurations to keep.
+    - workers: Number of processes, defaults to the number of cores.
+    - chunk_size: Number of configurations evaluated at once by a worker.
+
+    Yields:
+        list: Current top-k after each finished chunk as (score, scores per weighting, config), best first.
+    """
+    columns = list(df[[D1, D2]].columns)
+    arrays = {
+        "vacc": df[columns].to_numpy().astype(np.int64),
+        "pop": np.array([pop[grp] for _, grp in columns], dtype=np.int64),
+    }
+    yield from _sweep(columns, arrays, dict(), weights, configs, **kwargs)
+
+
+def sweep_at(region, weights, configs, folder=STORE_FOLDER, **kwargs):
+    """`sweep` for `region` of the Austrian data in the store (see `store.export_at`).
+    The workers open the memory-mapped vaccinations themselves instead of getting a copy.
+    Arguments and results are the same as for `sweep`."""
+    vacc, labels = load_array("at_vaccinations", folder)
+    population, pop_labels = load_array("at_population", folder)
+    doses = [labels["dose"].index(d) for d in [D1, D2]]
+    if doses[1] == doses[0] + 1:  # slice instead of a list, s.t. the array isn't copied
+        doses = slice(doses[0], doses[1] + 1)
+    index = (slice(None), labels["Region"].index(region), doses)
+    columns = [(d, grp) for d in [D1, D2] for grp in labels["group"]]
+    pop = population[pop_labels["Region"].index(region)]
+    arrays = {"pop": np.tile(pop, 2).astype(np.int64)}
+    stored = {"vacc": ("at_vaccinations", folder, index)}
+    yield from _sweep(columns, arrays, stored, weights, configs, **kwargs)
+
+
+def _sweep(
+    columns,
+    arrays,
+    stored,
+    weights,
+    configs,
+    *,
+    distr_first=False,
+    rank_by=None,
+    top_k=10,
+    workers=None,
+    chunk_size=256,
+):
+    groups = [grp for d, grp in columns if d == D1]
+    weight_names = list(weights)
+    rank_by = rank_by or weight_names[0]
+    arrays = dict(arrays)
+    for i, w in enumerate(weights.values()):
+        arrays[f"w_{i}"] = w.reindex(groups).fillna(0).to_numpy(dtype=float)
+
+    workers = workers or os.cpu_count()
+    configs = iter(configs)
+    chunks = iter(lambda: list(itertools.islice(configs, chunk_size)), [])
+    best, counter = [], itertools.count()  # min-heap of the top-k
+    blocks, specs = _share(arrays)
+    try:
+        with ProcessPoolExecutor(
+            workers, initializer=_attach, initargs=(specs, stored)
+        ) as ex:
+            args = (columns, weight_names, rank_by, distr_first, top_k)
+            pending = set()
+            for chunk in itertools.islice(chunks, 2 * workers):
+                pending.add(ex.submit(_score_chunk, chunk, *args))
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    for score, scores, config in future.result():
+                        entry = (score, next(counter), scores, config)
+                        if len(best) < top_k:
+                            heapq.heappush(best, entry)
+                        else:
+                            heapq.heappushpop(best, entry)
+                    chunk = next(chunks, None)
+                    if chunk:
+                        pending.add(ex.submit(_score_chunk, chunk, *args))
+                yield [(s, scores, c) for s, _, scores, c in sorted(best, reverse=True)]
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+# %%
@@ -0,0 +1,277 @@
+# %%
+import numpy as np
+import pandas as pd
+
+from data_loading import (
+    AGE_GROUPS,
+    D1,
+    D2,
+    UN_AGE_GROUPS,
+    US_POPULATION,
+    age_brackets,
+    age_membership,
+    death_shares_by_age,
+    get_age_data_un,
+    get_death_distr_by_age_us,
+)
+from profiling import profile
+
+# Uncertain inputs, each sample draws uniformly from these ranges (low, high).
+# Efficacy once a dose has full effect, around EFFICACY_D1/EFFICACY_D2 of immunity.py
+EFFICACY = {D1: (0.80, 0.95), D2: (0.90, 0.98)}
+# Days until a dose has full effect, around the curve points of `VaccineEfficacy` in old/FDF.py.
+# The first dose has no effect during the first FIRST_DOSE_DELAY days.
+RAMP_DAYS = {D1: (14, 28), D2: (7, 21)}
+FIRST_DOSE_DELAY = 7
+# Concentration of the US age profile used to split age brackets elsewhere (see
+# `sample_rebinning`), the share p of an age bracket varies by about sqrt(p / concentration)
+PROFILE_CONCENTRATION = 1000
+
+PERCENTILES = (5, 50, 95)
+
+
+# %% Samples of the inputs
+def sample_parameters(n, seed=0, efficacy=EFFICACY, ramp_days=RAMP_DAYS) -> dict:
+    """`n` samples of the efficacy of each dose and the days until it has full effect.
+
+    Returns:
+        dict: Arrays of length `n`: "efficacy_1D", "efficacy_2D", "ramp_1D", "ramp_2D"
+    """
+    rng = np.random.default_rng(seed)
+    params = dict()
+    for d in [D1, D2]:
+        params[f"efficacy_{d}"] = rng.uniform(*efficacy[d], n)
+        low, high = ramp_days[d]
+        params[f"ramp_{d}"] = rng.integers(low, high + 1, n)
+    return params
+
+
+def sample_shares(counts, n, seed=0, concentration=None) -> np.ndarray:
+    """`n` samples of the shares of `counts` (e.g. deaths per age group), shape (n, len(counts)).
+
+    Shares are drawn from a Dirichlet distribution around the observed shares. By default its
+    concentration is the total count (uncertainty of a sample of that size), a smaller
+    `concentration` gives wider bands, e.g. to account for using the US distribution elsewhere.
+    """
+    counts = np.asarray(counts, dtype=float)
+    concentration = concentration or counts.sum()
+    alpha = np.maximum(counts / counts.sum() * concentration, 1e-6)
+    return np.random.default_rng(seed).dirichlet(alpha, n)
+
+
+def sample_rebinning(
+    source,
+    target,
+    n,
+    seed=0,
+    profile=US_POPULATION,
+    concentration=PROFILE_CONCENTRATION,
+) -> np.ndarray:
+    """`n` samples of `rebinning_matrix(source, target, profile)`, shape (n, sources, targets).
+
+    The population of each bracket of `profile` is drawn with `sample_shares`.
+    """
+    shares = sample_shares(list(profile.values()), n, seed, concentration)
+    oldest = max(upper for _, upper in [*source.values(), *target.values(), *profile])
+    brackets = age_membership(dict(enumerate(profile)), oldest)
+    people = shares @ (brackets / brackets.sum(axis=1, keepdims=True))  # samples x ages
+    weights = age_membership(source, oldest) * people[:, None, :]
+    weights /= weights.sum(axis=-1, keepdims=True)
+    return weights @ age_membership(target, oldest).T
+
+
+def sample_age_data(
+    n, seed=0, groups=AGE_GROUPS, concentration=PROFILE_CONCENTRATION
+) -> pd.DataFrame:
+    """`n` samples of `get_age_data(groups)`, the US-based split of the UN age brackets is drawn
+    with `sample_rebinning`.
+
+    Returns:
+        pd.DataFrame: One row per sample, columns are (location, group)
+    """
+    un = get_age_data_un()
+    source, target = age_brackets(UN_AGE_GROUPS), age_brackets(groups)
+    matrices = sample_rebinning(source, target, n, seed, concentration=concentration)
+    values = un.to_numpy(dtype=float) @ matrices  # samples x locations x groups
+    columns = pd.MultiIndex.from_product([un.index, list(groups)])
+    return pd.DataFrame(values.round().reshape(n, -1), columns=columns)
+
+
+def sample_death_shares_by_age(age_samples, reference="United States") -> pd.DataFrame:
+    """Samples of the share of deaths per age group of each location as in
+    `get_death_data_by_age`, for samples of the population from `sample_age_data`.
+
+    Returns:
+        pd.DataFrame: One row per sample, columns are (location, group)
+    """
+    locations = list(age_samples.columns.unique(level=0))
+    groups = list(age_samples[locations[0]].columns)
+    age = age_samples.to_numpy(dtype=float).reshape(
+        len(age_samples), len(locations), -1
+    )
+    death_distr = get_death_distr_by_age_us()["DeathShare"][groups].to_numpy(
+        dtype=float
+    )
+    shares = death_shares_by_age(age, death_distr, locations.index(reference))
+    return pd.DataFrame(
+        shares.reshape(len(age_samples), -1), columns=age_samples.columns
+    )
+
+
+# %% Immunity of all samples at once
+def _ramp(cum2, efficacy, start, end):
+    # Immunity if the efficacy rises linearly from day `start` to `end` after vaccination,
+    # cum2 is the vaccinated share summed twice over the days, shape (samples, regions, days):
+    # sum_i x[i] * clip((t - i + 1 - start) / (end - start), 0, 1)
+    #   = (cum2[t - start] - cum2[t - end]) / (end - start)
+    n_days = cum2.shape[-1]
+    pad = int(end.max())
+    padded = np.concatenate([np.zeros((*cum2.shape[:-1], pad)), cum2], axis=-1)
+    days = np.arange(n_days) + pad
+
+    def shifted(lag):  # cum2[t - lag] for every sample
+        index = np.broadcast_to((days - lag[:, None])[:, None, :], cum2.shape)
+        return np.take_along_axis(padded, index, axis=-1)
+
+    scale = (efficacy / (end - start))[:, None, None]
+    return scale * (shifted(start) - shifted(end))
+
+
+@profile
+def immunity_samples(d1, d2, pop, params, weights, delay=FIRST_DOSE_DELAY) -> dict:
+    """Weighted immunity for every sample of the parameters.
+
+    Everyone with a first dose gets the efficacy of the first dose after `delay` + its ramp days,
+    a second dose adds the difference to the efficacy of the second dose after its ramp days.
+    With `delay=0` and ramps of 1 day this is `get_avg_immunity`, weighted as in
+    `calc_weighted_immunity`.
+
+    Args:
+    - d1, d2: Daily first/second doses, shape (regions, days, groups).
+    - pop: Population, shape (regions, groups) or with samples as first axis.
+    - params: Samples of the parameters, see `sample_parameters`.
+    - weights: Dict of name -> weight per group, shape (groups,), (regions, groups) or with samples
+        as first axis, (samples, groups) or (samples, regions, groups), see `sample_shares`.
+
+    Returns:
+        dict: Name -> immunity with shape (samples, regions, days)
+    """
+    n = len(params[f"efficacy_{D1}"])
+    pop = np.asarray(pop, dtype=float)
+    if pop.ndim == 2:
+        pop = pop[None]  # same population for all samples
+    # summed twice over the days, s.t. every ramp is a difference of two values
+    cum2 = [np.asarray(d, dtype=float).cumsum(axis=1).cumsum(axis=1) for d in [d1, d2]]
+    result = dict()
+    for name, w in weights.items():
+        w = np.asarray(w, dtype=float)
+        if w.ndim == 1 or (w.ndim == 2 and w.shape[0] != n):
+            w = w[None]  # same weights for all samples
+        if w.ndim == 2:
+            w = w[:, None, :]  # same weights for all regions
+        w = w / w.sum(axis=-1, keepdims=True)
+        # the vaccinated share is doses / pop, divide the weights instead of the doses
+        w = w / pop
+        # weight first, the ramps only shift the days:
+        # (1 or samples, regions, days, groups) x (.., groups, 1)
+        wc = [(c[None] @ w[..., None])[..., 0] for c in cum2]
+        wc = [np.broadcast_to(c, (n, *c.shape[1:])) for c in wc]
+        e1, e2 = params[f"efficacy_{D1}"], params[f"efficacy_{D2}"]
+        start = np.full(n, delay)
+        imm = _ramp(wc[0], e1, start, start + params[f"ramp_{D1}"])
+        imm += _ramp(wc[1], e2 - e1, np.zeros(n, int), params[f"ramp_{D2}"])
+        result[name] = imm
+    return result
+
+
+def percentile_bands(samples, index, regions, percentiles=PERCENTILES) -> pd.DataFrame:
+    """Percentiles over the samples (first axis) of an array with shape (samples, regions, days).
+
+    Returns:
+        pd.DataFrame: Dates as index, columns are (region, percentile)
+    """
+    bands = np.percentile(samples, percentiles, axis=0)  # percentiles x regions x days
+    columns = pd.MultiIndex.from_product([regions, list(percentiles)])
+    values = bands.transpose(2, 1, 0).reshape(len(index), -1)
+    return pd.DataFrame(values, index=index, columns=columns)
+
+
+# %%
+def immunity_bands(
+    schedules,
+    population,
+    weights,
+    regions=None,
+    n=2000,
+    seed=0,
+    percentiles=PERCENTILES,
+) -> pd.DataFrame:
+    """Percentile bands of the weighted immunity per region and date.
+
+    Weighting by population is always included. With deaths per age group as weights, the
+    weighted immunity is the share of deaths averted (same risk for everyone in an age group).
+    All schedules use the same samples, the differences to the first schedule are reported as well.
+
+    Args:
+    - schedules: Dict of name -> vaccinations as returned by `get_vaccinations_at`, columns are
+        (Region, dose, group), e.g. also one scenario of `redistribute_doses_batch`.
+    - population pd.DataFrame: Population per age group (index) and region (columns), see `get_demographics_at`,
+        or `n` samples of it, i.e. one row per sample and (region, group) as columns (see `sample_age_data`).
+    - weights: Dict of name -> weights per age group (pd.Series, missing groups get 0)
+        or samples of them, i.e. a DataFrame with one row per sample and groups or (region, group)
+        as columns (see `sample_shares`, `sample_death_shares_by_age`).
+    - regions: Regions to calculate, defaults to all regions of the first schedule.
+    - n: Number of samples.
+
+    Returns:
+        pd.DataFrame: Dates as index, columns are (Region, schedule, weighting, percentile)
+    """
+    first, *others = schedules
+    df = schedules[first]
+    regions = regions or list(df.columns.unique(level=0))
+    groups = list(df[regions[0]][D1].columns)
+
+    def by_region(samples):  # samples x regions x groups
+        columns = pd.MultiIndex.from_product([regions, groups])
+        values = samples.reindex(columns=columns).fillna(0).to_numpy(dtype=float)
+        return values.reshape(len(samples), len(regions), len(groups))
+
+    if isinstance(population.columns, pd.MultiIndex):  # samples
+        if len(population) != n:
+            raise ValueError(f"Expected {n} population samples, got {len(population)}")
+        pop = by_region(population)
+    else:
+        pop = np.stack([population[r][groups].to_numpy() for r in regions])
+    w = {"Population": pop}
+    for name, weight in weights.items():
+        if isinstance(weight, pd.DataFrame) and isinstance(
+            weight.columns, pd.MultiIndex
+        ):
+            w[name] = by_region(weight)
+        elif isinstance(weight, pd.DataFrame):  # samples
+            w[name] = weight.reindex(columns=groups).fillna(0).to_numpy()
+        else:
+            w[name] = weight.reindex(groups).fillna(0).to_numpy()
+
+    params = sample_parameters(n, seed)
+    samples = dict()
+    for schedule, df in schedules.items():
+        d1, d2 = [
+            np.stack([df[r][d][groups].to_numpy() for r in regions]) for d in [D1, D2]
+        ]
+        samples[schedule] = immunity_samples(d1, d2, pop, params, w)
+    for schedule in others:
+        samples[f"{schedule} - {first}"] = {
+            name: s - samples[first][name] for name, s in samples[schedule].items()
+        }
+
+    bands = {
+        (schedule, name): percentile_bands(s, df.index, regions, percentiles)
+        for schedule, by_weight in samples.items()
+        for name, s in by_weight.items()
+    }
+    result = pd.concat(bands, axis=1)  # (schedule, weighting, region, percentile)
+    return result.reorder_levels([2, 0, 1, 3], axis=1)[regions]
+
+
+# %%
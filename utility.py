@@ -1,5 +1,8 @@
 #%%
+import os
 import re
+import tempfile
+from contextlib import contextmanager
 from pathlib import Path
 
 import pandas as pd
@@ -7,30 +10,107 @@ import pandas as pd
 OUT_FOLDER = Path("fdf_posts")
 
 
+@contextmanager
+def atomic_write(path):
+    """Open a temporary file next to `path` for writing (binary), it replaces `path` once the
+    block finishes without error. Readers never see half-written files, an interrupted write
+    leaves the old file."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
 def fix_multilevel(df: pd.DataFrame) -> pd.DataFrame:
     df.columns = pd.MultiIndex.from_tuples(df.columns)
     return df
 
 
-def write_to_file(file, name, value):
-    pattern_tag = rf"\[//\]: # \({name}\)"
+class ReportDocument:
+    """Markdown post with sections that are delimited by two `[//]: # (name)` tags.
 
-    pattern_full = rf"({pattern_tag})([\s\S]*)({pattern_tag})"
-    file_content = file.read_text()
+    The file is parsed once, sections are replaced in memory and `flush` writes the file
+    (only if something changed). As context manager it flushes on exit.
+    """
 
-    # print("===================")
-    # print(re.findall(pattern_tag, file_content))
-    # print(re.findall(pattern_full, file_content))
-    # print("===================")
-    repl = re.sub(pattern_full, rf"\1\n\n{value.strip()}\n\n\3", file_content)
-    file.write_text(repl)
+    pattern = re.compile(
+        r"(?P<open>\[//\]: # \((?P<name>[^)\n]*)\))"
+        r"(?P<body>[\s\S]*?)"
+        r"(?P<close>\[//\]: # \((?P=name)\))"
+    )
 
+    def __init__(self, file):
+        self.file = Path(file)
+        with open(self.file, encoding="utf-8", newline="") as f:
+            text = f.read()
+        self.newline = "\r\n" if "\r\n" in text else "\n"
+        self._saved = text.replace("\r\n", "\n")
+        # text between sections, tags and section contents; `sections` are the indices of the latter
+        self.parts, self.sections = [], dict()
+        end = 0
+        for m in self.pattern.finditer(self._saved):
+            self.parts += [self._saved[end : m.start()], m["open"]]
+            self.sections[m["name"]] = len(self.parts)
+            self.parts += [m["body"], m["close"]]
+            end = m.end()
+        self.parts.append(self._saved[end:])
 
-def write_img_to_file(file, name, path: Path, alt_text=None, caption=None):
+    def __contains__(self, name):
+        return name in self.sections
+
+    def __getitem__(self, name) -> str:
+        return self.parts[self.sections[name]].strip()
+
+    def __setitem__(self, name, value):
+        self.parts[self.sections[name]] = f"\n\n{value.strip()}\n\n"
+
+    def set_image(self, name, path: Path, alt_text=None, caption=None):
+        self[name] = img_tag(path, alt_text, caption)
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def flush(self) -> bool:
+        """Write the file if it was changed, returns whether it was written"""
+        text = self.text
+        if text == self._saved:
+            return False
+        with open(self.file, "w", encoding="utf-8", newline=self.newline) as f:
+            f.write(text)
+        self._saved = text
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+def img_tag(path: Path, alt_text=None, caption=None) -> str:
     path = path.relative_to(OUT_FOLDER)
     x = str(path).replace("\\", "/")
-    # print(x)
     c = f"{caption}\n" if caption else ""
     alt_text = alt_text or ""
-    img_tag = f"{c}![{alt_text}]({x})"
-    write_to_file(file, name, img_tag)
+    return f"{c}![{alt_text}]({x})"
+
+
+def write_to_file(file, name, value):
+    """Replace section `name` of `file` (path or `ReportDocument`), unknown sections are ignored.
+    A `ReportDocument` is only changed in memory, a path is written right away."""
+    doc = file if isinstance(file, ReportDocument) else ReportDocument(file)
+    if name in doc:
+        doc[name] = value
+    if doc is not file:
+        doc.flush()
+
+
+def write_img_to_file(file, name, path: Path, alt_text=None, caption=None):
+    write_to_file(file, name, img_tag(path, alt_text, caption))